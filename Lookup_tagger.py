@@ -1,17 +1,35 @@
 
 # Import libraries
-from bs4 import BeautifulSoup
-import xmlschema
+# The heavy libraries (bs4, lxml, pandas, numpy and requests) are imported in the functions using them,
+# so importing the module (e.g. in short-lived workers or for the XSD-only path) stays fast.
 import glob
+import os
+import hashlib
+import pickle
+import json
+import sqlite3
+import time
+import traceback
+import tracemalloc
+import multiprocessing
+import xml.etree.ElementTree as ET
 from zipfile import ZipFile
 from io import BytesIO
-import requests
-import pandas as pd
 import re
+import math
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
 from rapidfuzz import fuzz
 from rapidfuzz import process
+from rapidfuzz import utils
 from Xbrl_Parser import read_xbrl
 
+# US-GAAP taxonomy excel file (zip) and the folder where the cleaned taxonomy data is cached
+TAXONOMY_URL = 'https://www.fasb.org/cs/BlobServer?blobkey=id&blobnocache=true&blobwhere=1175836290847&blobheader=application%2Fzip&blobheadername2=Content-Length&blobheadername1=Content-Disposition&blobheadervalue2=9013838&blobheadervalue1=attachment%3B+filename%3DUS_GAAP_Taxonomy_2021.zip&blobcol=urldata&blobtable=MungoBlobs'
+TAXONOMY_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxonomy_cache')
+MATCH_CACHE = os.path.join(TAXONOMY_CACHE, 'match_cache.sqlite')
+
 """ FUNCTIONS """
 
 def has_name(tag):
@@ -21,16 +39,64 @@ def has_name(tag):
     return tag.has_attr('name')
 
 
+# Precompiled patterns of the text normalization and monetary values
+unicode_space_pattern = re.compile(r'(\xa0\s*)+')
+char_ref_pattern = re.compile(r'(&#\d+;\s*)+')
+money_pattern = re.compile(r'\s*\(?(\d+(,\d+)+)\)?\s*') #pattern to match monetary values
+money_chars_pattern = re.compile(r'\(|\)|,|\s')
+
+
+# Only the strings up to this length are cached by remove_unicode and parse_money (cell texts, row titles),
+# so the caches do not keep the long texts of the paragraphs and text blocks
+CACHE_MAX_LENGTH = 200
+
 def remove_unicode(string):
     """
     Function to remove Unicode characters in a string
     """
-    string_unicode = re.sub(pattern='(\xa0\s*)+', repl=' ', string=string)
+    # Plain str, so the cache does not keep the bs4 strings (and their documents) alive
+    string = str(string)
+    if len(string) <= CACHE_MAX_LENGTH:
+        return _remove_unicode(string)
+    return _remove_unicode_text(string)
+
+
+def _remove_unicode_text(string):
+    # Fast path: pure ASCII text without character references is not changed
+    if string.isascii() and ('&#' not in string):
+        return string
+    string_unicode = unicode_space_pattern.sub(' ', string)
     string_encode = string_unicode.encode("ascii", "xmlcharrefreplace")
     string_decode = string_encode.decode()
-    string_decode = re.sub(pattern='(&#\d+;\s*)+', repl=' ', string=string_decode)
+    string_decode = char_ref_pattern.sub(' ', string_decode)
     return string_decode
 
+_remove_unicode = lru_cache(maxsize=65536)(_remove_unicode_text)
+
+
+def parse_money(string):
+    """
+    Function to parse a monetary value in a table cell, e.g. "1,234" or "(1,234)"
+    Returns a tuple of (value as int, "Positive" or "Negative"), or None if the string is not a monetary value
+    """
+    string = str(string)
+    if len(string) <= CACHE_MAX_LENGTH:
+        return _parse_money(string)
+    return _parse_money_text(string)
+
+
+def _parse_money_text(string):
+    if not money_pattern.fullmatch(string):
+        return None
+    value = int(money_chars_pattern.sub('', string))
+    if string.startswith('('):
+        sign = 'Negative'
+    else:
+        sign = 'Positive'
+    return (value, sign)
+
+_parse_money = lru_cache(maxsize=65536)(_parse_money_text)
+
 
 def strDetached(string, split=True, split_by=':'):
     """
@@ -53,32 +119,229 @@ def strDetached(string, split=True, split_by=':'):
     return detached_string
 
 
-def LoadHTML(html_file):
+def LoadHTML(html_file, parser='html.parser'):
     """
     Read an html file using bs4 html parser
+
+    parser: BeautifulSoup parser backend, 'html.parser' (default), 'lxml' (faster) or 'html5lib'.
     """
+    from bs4 import BeautifulSoup
+
     with open(html_file, 'rb') as f:
         html_doc = f.read()
 
-    parsed_html = BeautifulSoup(html_doc, 'html.parser')
+    parsed_html = BeautifulSoup(html_doc, parser)
+
+    if parser not in ('html.parser', 'html5lib'):
+        # Only html.parser and html5lib report the source position of the elements, which is used in the tag ids.
+        # For other parsers the position of the element in the document is used as its line number.
+        for n, tag in enumerate(parsed_html.find_all()):
+            tag.sourceline = n
+            tag.sourcepos = 0
 
     print(f'File "{html_file}" is loaded.')
     return parsed_html
 
 
-def firmDict(xbrl_FilePath, firm_facts):
+def tableModel(parsed_html):
+    """
+    Indexes the table rows of a parsed html document in one pass, so the rows are not searched again 
+    with find_parent('tr') for every element.
+    Returns a dict of {id(element): row} for every element in a table row (see tableRow), where row is the dict 
+    of the nearest parent "tr" of the element:
+        'index': position of the row in the document
+        'element': the "tr" element
+        'title': text of the first cell of the row (None if the row has no "td")
+        'cells': list of (cell element, value, sign) for the cells (children) of the row having a monetary value
+    """
+    from bs4 import Tag
+
+    row_of = {}
+    n_rows = 0
+
+    body = parsed_html.body
+    stack = [(child, None) for child in reversed(body.contents) if isinstance(child, Tag)]
+    while stack:
+        tag, row = stack.pop()
+        if row is not None:
+            row_of[id(tag)] = row
+
+        if tag.name == 'tr':
+            cells = []
+            for st in tag.contents:
+                if isinstance(st, Tag) and (st.string) and (not st.string.isspace()):
+                    money = parse_money(st.string)
+                    if money:
+                        cells.append((st, money[0], money[1]))
+            title = remove_unicode(tag.td.text).strip() if tag.td else None
+            row = {'index': n_rows, 'element': tag, 'title': title, 'cells': cells}
+            n_rows += 1
+
+        stack.extend((child, row) for child in reversed(tag.contents) if isinstance(child, Tag))
+
+    return row_of
+
+
+def tableRow(table_rows, element):
+    """
+    Returns the row (see tableModel) of the table containing the element, or None if the element is not in a table row.
+    """
+    return table_rows.get(id(element))
+
+
+# Block elements of the narrative text of a report
+TEXT_BLOCK_TAGS = ['p', 'div', 'li']
+
+def textBlocks(parsed_html, table_rows, min_words=8):
+    """
+    Finds the narrative text blocks of a parsed html document: the innermost "p", "div" or "li" elements 
+    which are not in a table row, do not contain a table and have at least min_words words.
+    The elements in table rows are never mapped to a block, so their tags are always looked up in the tables.
+    Returns a list of blocks, and a dict of {id(element): block} for the blocks and all the elements in them 
+    (see textBlock). A block is a dict of:
+        'index': position of the block in the document
+        'element': the block element
+        'text': text of the block
+    """
+    blocks = []
+    block_of = {}
+    for elmnt in parsed_html.body.find_all(TEXT_BLOCK_TAGS):
+        # Skip the elements in a table row, the outer blocks, and the blocks wrapping a table (e.g. <div><table>)
+        if tableRow(table_rows, elmnt) or elmnt.find(TEXT_BLOCK_TAGS) or elmnt.find(['table', 'tr']):
+            continue
+        text = remove_unicode(elmnt.get_text()).strip()
+        if len(text.split()) < min_words:
+            continue
+
+        block = {'index': len(blocks), 'element': elmnt, 'text': text}
+        blocks.append(block)
+        block_of[id(elmnt)] = block
+        for child in elmnt.find_all():
+            if not tableRow(table_rows, child):
+                block_of[id(child)] = block
+
+    return blocks, block_of
+
+
+def textBlock(text_blocks, element):
+    """
+    Returns the narrative text block (see textBlocks) containing the element, or None.
+    """
+    return text_blocks.get(id(element))
+
+
+class StreamElement():
+
+    def __init__(self, attrs, sourceline, sourcepos, string):
+        """
+        Text data of an html element read by iterHTML, with the attributes of a bs4 element used by get_tag_data.
+        sourcepos is the position of the element in the document, since lxml does not report the column.
+        """
+        self.attrs = attrs
+        self.sourceline = sourceline
+        self.sourcepos = sourcepos
+        self.string = string
+
+    def has_attr(self, key):
+        return key in self.attrs
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+
+def iterHTML(html_file):
+    """
+    Reads an html file incrementally with lxml iterparse, and yields the text data of the elements in its body 
+    without keeping the whole document in memory. Every element is released after it is read, except for the 
+    elements of the current table row.
+    Yields (elements, row) tuples:
+        elements: list of StreamElement with text data (same as the bs4 ".string" of the element).
+        row: list of StreamElement of the cells (children) of the table row containing the elements, or None 
+            for elements not in a table row.
+    """
+    from lxml import etree
+
+    in_body = False
+    ordinal = 0
+    frames = []     # one frame per open element: [ordinal, number of children, string of the only child]
+    rows = []       # one buffer per open table row: [list of (ordinal, depth, StreamElement)]
+
+    for event, elem in etree.iterparse(html_file, events=('start', 'end', 'comment', 'pi'), html=True, huge_tree=True):
+        if event in ('comment', 'pi'):
+            # Comments and processing instructions are children of the element in bs4 too (see ".string" below)
+            if in_body:
+                frames[-1][1] += 1
+                frames[-1][2] = elem.text
+            continue
+
+        if event == 'start':
+            if in_body:
+                frames[-1][1] += 1
+                if elem.tag == 'tr':
+                    rows.append([])
+            elif elem.tag == 'body':
+                in_body = True
+            frames.append([ordinal, 0, None])
+            ordinal += 1
+            continue
+
+        n, n_children, child_string = frames.pop()
+        if elem.tag == 'body':
+            break
+        if not in_body:
+            continue
+
+        # The ".string" of an element: its text if it has no children, or the ".string" of its only child
+        # (the text of a comment, as a bs4 Comment is its own ".string")
+        if n_children == 0:
+            string = elem.text
+        elif (n_children == 1) and (len(elem) == 1) and (not elem.text) and (not elem[0].tail):
+            string = child_string
+        else:
+            string = None
+        frames[-1][2] = string
+
+        element = StreamElement(dict(elem.attrib), elem.sourceline, n, string)
+        if elem.tag == 'tr':
+            # The row is complete: yield its elements in document order with its cells
+            buffer = rows.pop()
+            cells = [e for _, depth, e in buffer if depth == len(frames) + 1]
+            buffer.sort(key=lambda rec: rec[0])
+            elements = [e for _, _, e in buffer if e.string]
+            if elements:
+                yield elements, cells
+
+        if rows:
+            rows[-1].append((n, len(frames), element))
+        elif string:
+            yield [element], None
+
+        # Release the children of the element and its previous siblings
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def firmDict(xbrl_FilePath, firm_facts, documents=None):
     """
     Creates a lookup dictionary from tagged monetary data in tables and the firm specific facts in previously filed xbrl report.
     Returns a list of [tables_dict, firm_dict]
+
+    documents: DocumentCache used to load the xbrl report. If None, the report is loaded with LoadHTML.
     """
     tables_dict = {}
     firm_dict = {}
 
-    # regex is used to find monetary values in tables and add their row titles to lookup_dict 
-    money_pattern = '\s*\(?(\d+(,\d+)+)\)?\s*' #pattern to match monetary values
-
+    # regex (money_pattern) is used to find monetary values in tables and add their row titles to lookup_dict 
     # Find all the 'table' elements in the parsed xbrl report
-    parsed_xbrl = LoadHTML(html_file=xbrl_FilePath)
+    if documents is not None:
+        parsed_xbrl = documents.load(xbrl_FilePath)
+        table_rows = documents.tables(xbrl_FilePath, parsed_xbrl)
+    else:
+        parsed_xbrl = LoadHTML(html_file=xbrl_FilePath)
+        table_rows = tableModel(parsed_xbrl)
     tables = parsed_xbrl.body.find_all('table')
 
     # Loop over the tables and add their row titles to lookup_dict
@@ -94,14 +357,11 @@ def firmDict(xbrl_FilePath, firm_facts):
                 # Check if the fact type is numeric
                 if tag.name == 'ix:nonfraction':
                     # Check if the fact is a monetary value
-                    if re.fullmatch(pattern=money_pattern, string=string):
-                        try:
-                            # If the monatry value is in a table, use the row title as fact
-                            tbl_row = tag.find_parent('tr')
-                            fact = remove_unicode(tbl_row.td.text).strip()
-                            tables_dict[fact] = label
-                        except:
-                            pass
+                    if money_pattern.fullmatch(string):
+                        # If the monatry value is in a table, use the row title as fact
+                        tbl_row = tableRow(table_rows, tag)
+                        if tbl_row and (tbl_row['title'] is not None):
+                            tables_dict[tbl_row['title']] = label
 
     if firm_facts:
         # Add values from selected_facts (firm specific facts) to lookup_dict
@@ -112,9 +372,214 @@ def firmDict(xbrl_FilePath, firm_facts):
     print("Firm specific lookup dictionary created from the previously filed xbrl report")
     return [tables_dict, firm_dict]
     
-def get_tag_data(element, Tags_dict, name, Elements_df=None, References_df=None, xsd_dict=None):
+def batch_match(strings, lookup_dict, score_cutoff=95, workers=-1, chunk_size=2000):
+    """
+    Matches all the strings against the keys of lookup_dict in one vectorized pass using rapidfuzz.process.cdist.
+    Returns a dict of {string: best matching key} for the strings having a match with WRatio >= score_cutoff.
+
+    strings: iterable of the (cleaned) text data to be matched.
+    lookup_dict: dict whose keys are the strings to be matched.
+    score_cutoff: minimum WRatio score of a match.
+    workers: number of threads used by cdist. -1 uses all the available cores.
+    chunk_size: number of strings scored per cdist call, to limit the size of the score matrix.
+    """
+    import numpy as np
+
+    # Filings repeat the same texts, so every unique string is scored once
+    strings = list(dict.fromkeys(strings))
+    keys = list(lookup_dict.keys())
+    matches = {}
+    if not strings or not keys:
+        return matches
+
+    for start in range(0, len(strings), chunk_size):
+        chunk = strings[start:start+chunk_size]
+        scores = process.cdist(chunk, keys, scorer=fuzz.WRatio, processor=utils.default_process, 
+                            score_cutoff=score_cutoff, dtype=np.float64, workers=workers)
+
+        # argmax returns the first best key, same as process.extractOne
+        best = scores.argmax(axis=1)
+        for i, string in enumerate(chunk):
+            if scores[i, best[i]] >= score_cutoff:
+                matches[string] = keys[best[i]]
+
+    return matches
+
+
+def loadTaxonomyExcel(taxonomy_zip=None, cache_dir=TAXONOMY_CACHE, version='2021'):
+    """
+    Reads the "Elements" and "References" sheets of the US-GAAP taxonomy excel file, removes the label suffixes 
+    and the deprecated items. The cleaned data is cached in cache_dir by taxonomy version (or by the name and 
+    content hash of taxonomy_zip), so the next loads are read from the disk without downloading and parsing the excel file.
+    Returns a list of [Elements_df, References_df]
+
+    taxonomy_zip: path of a local copy of the taxonomy zip file. If None, the file is downloaded from TAXONOMY_URL.
+    cache_dir: folder of the cached taxonomy data. If None, the cache is not used.
+    version: taxonomy version, used as the key of the cached data of the downloaded file.
+    """
+    import pandas as pd
+
+    cache_file = None
+    if cache_dir is not None:
+        if taxonomy_zip is None:
+            cache_key = version
+        else:
+            # A local zip is cached by its name and content, so another zip never reads its cached data
+            zip_hash = hashlib.md5()
+            with open(taxonomy_zip, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    zip_hash.update(block)
+            name = os.path.splitext(os.path.basename(taxonomy_zip))[0]
+            cache_key = f'{version}_{name}_{zip_hash.hexdigest()[:12]}'
+        cache_file = os.path.join(cache_dir, f'US_GAAP_Taxonomy_{cache_key}.pkl')
+        if os.path.exists(cache_file):
+            cached = pd.read_pickle(cache_file)
+            print(f'Taxonomy data loaded from cache: {cache_file}')
+            return [cached['Elements'], cached['References']]
+
+    if taxonomy_zip is None:
+        # Download the zip file contents in binary format
+        import requests
+        r = requests.get(TAXONOMY_URL)
+        r.raise_for_status()
+        taxonomy_zip = BytesIO(r.content)
+        print(f'Taxonomy excel file downloaded.')
+
+    # Read the content of the zip file
+    with ZipFile(taxonomy_zip, 'r') as zipObj:
+        with zipObj.open(zipObj.namelist()[0]) as f:
+            file = pd.ExcelFile(BytesIO(f.read()))
+
+    # Read required sheets
+    Elements_df = file.parse(sheet_name='Elements')
+    pattern = '\[.*\]'
+    Elements_df.loc[:, 'label'] = Elements_df['label'].str.replace(pattern, '', regex=True).tolist()
+    # Remove depricated taxonomy items
+    Elements_df = Elements_df[Elements_df['deprecatedDate'].isna()]
+
+    References_df = file.parse(sheet_name='References', header=1)
+
+    if cache_file is not None:
+        # Write to a temporary file first, so parallel workers never read a partial cache file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        pd.to_pickle({'Elements': Elements_df, 'References': References_df}, tmp_file)
+        os.replace(tmp_file, cache_file)
+        print(f'Taxonomy data cached in: {cache_file}')
+
+    return [Elements_df, References_df]
+
+
+def compileTaxonomyXSD(resources, snapshot_file):
+    """
+    Extracts the name and type of the global elements of all the .xsd files in the resources folder, 
+    which is all the data get_tag_data needs, and saves them in a compact snapshot file.
+    The elements of all the files are kept (the xsd dicts are not updated over each other).
+    Returns the taxonomy dict {'xs:element': [{'@name': name, '@type': type}, ...]}
+
+    resources: path of the folder containing the Taxonomy (XSD) files.
+    snapshot_file: path of the snapshot file. If None, the snapshot is not saved.
+    """
+    xs = '{http://www.w3.org/2001/XMLSchema}'
+    all_files = sorted(glob.glob(os.path.join(resources, '*.xsd')))
+
+    xs_element = []
+    for f in all_files:
+        # The xsd files are read as plain XML, so no schema (and no remote import) is built
+        root = ET.parse(f).getroot()
+        for element in root.findall(xs + 'element'):
+            xs_element.append({'@name': element.get('name'), '@type': element.get('type')})
+
+    xsd_dict = {'xs:element': xs_element}
+
+    if snapshot_file is not None:
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+        tmp_file = f'{snapshot_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as fp:
+            pickle.dump({'files': [os.path.basename(f) for f in all_files], 'taxonomy': xsd_dict}, fp)
+        os.replace(tmp_file, snapshot_file)
+        print(f'Taxonomy snapshot saved in: {snapshot_file}')
+
+    return xsd_dict
+
+
+def loadTaxonomyXSD(resources, cache_dir=TAXONOMY_CACHE):
+    """
+    Loads the taxonomy data of the .xsd files in the resources folder from its snapshot in cache_dir, 
+    if the snapshot is newer than the .xsd files. Otherwise the snapshot is (re)compiled with compileTaxonomyXSD.
+    Returns the taxonomy dict {'xs:element': [{'@name': name, '@type': type}, ...]}
+
+    resources: path of the folder containing the Taxonomy (XSD) files.
+    cache_dir: folder of the snapshot files. If None, the xsd files are always compiled and no snapshot is saved.
+    """
+    if cache_dir is None:
+        return compileTaxonomyXSD(resources, None)
+
+    # One snapshot per resources folder
+    folder = os.path.abspath(resources)
+    folder_hash = hashlib.md5(folder.encode()).hexdigest()[:8]
+    snapshot_file = os.path.join(cache_dir, f'xsd_{os.path.basename(folder)}_{folder_hash}.pkl')
+
+    all_files = sorted(glob.glob(os.path.join(resources, '*.xsd')))
+    if os.path.exists(snapshot_file):
+        snapshot_time = os.path.getmtime(snapshot_file)
+        if all(os.path.getmtime(f) < snapshot_time for f in all_files):
+            with open(snapshot_file, 'rb') as fp:
+                snapshot = pickle.load(fp)
+            if snapshot['files'] == [os.path.basename(f) for f in all_files]:
+                print(f'Taxonomy snapshot loaded from: {snapshot_file}')
+                return snapshot['taxonomy']
+
+    return compileTaxonomyXSD(resources, snapshot_file)
+
+
+def taxonomyIndex(Elements_df=None, References_df=None, xsd_dict=None):
+    """
+    Creates a dict keyed by taxonomy item name from the taxonomy resources, so the data of a tag is found 
+    in O(1) instead of scanning the DataFrames or the xsd elements for every tag.
+    Returns {name: {'Attributes': {...}, 'Labels': {...}, 'References': {...}}}
+    """
+    taxonomy_index = {}
+
+    if (Elements_df is not None) and (References_df is not None):
+        # Only the first row of every name is used
+        for name, item_type, documentation, label in zip(Elements_df['name'].values, Elements_df['type'].values, 
+                                                    Elements_df['documentation'].values, Elements_df['label'].values):
+            if name not in taxonomy_index:
+                taxonomy_index[name] = {'Attributes': {'Type': item_type},
+                                        'Labels': {'Documentation': documentation, 'Label': label},
+                                        'References': {}}
+
+        ref_columns = ['Name', 'Number', 'Publisher', 'Section', 'Subsection']
+        referenced = set()
+        for rec in zip(References_df['name'].values, *[References_df[col].values for col in ref_columns]):
+            name = rec[0]
+            if name in referenced:
+                continue
+            referenced.add(name)
+            if name not in taxonomy_index:
+                taxonomy_index[name] = {'Attributes': {}, 'Labels': {}, 'References': {}}
+            taxonomy_index[name]['References'] = dict(zip(ref_columns, rec[1:]))
+
+    elif xsd_dict is not None:
+        for xs in xsd_dict.get('xs:element', []):
+            name = xs.get('@name')
+            if name not in taxonomy_index:
+                taxonomy_index[name] = {'Attributes': {'Type': strDetached(xs.get('@type'))},
+                                        'Labels': {'Label': strDetached(xs.get('@name'))},
+                                        'References': {}}
+
+    return taxonomy_index
+
+
+def get_tag_data(element, Tags_dict, name, Elements_df=None, References_df=None, xsd_dict=None, taxonomy_index=None, 
+                position=None):
     """
     Funcion to get required data from taxonomy resources based on tag name, and add the tag and the data to the Tags_dict.
+
+    taxonomy_index: dict created by taxonomyIndex (fast path, used by LookupTagger). If not given, the data is 
+        searched in Elements_df and References_df, or xsd_dict.
+    position: position of the tagged text in the text of the element (for the entities of a text block), added to the id.
     """
     # Define a unique "id" for the tag
     # id: line number - position of the start tag within a line - label
@@ -122,6 +587,8 @@ def get_tag_data(element, Tags_dict, name, Elements_df=None, References_df=None,
         id = element['id']
     else:
         id = str(element.sourceline) + '-' + str(element.sourcepos) + '-' + name
+    if position is not None:
+        id = id + '-' + str(position)
                     
     Tags_dict[id] = {'Attributes': {},
                     'Labels': {},
@@ -130,7 +597,15 @@ def get_tag_data(element, Tags_dict, name, Elements_df=None, References_df=None,
     Tags_dict[id]['Attributes']['Tag'] = name
                                     
     # Get other information from the taxonomy resources based on tag's "name"
-    if (Elements_df is not None) and (References_df is not None):
+    if taxonomy_index is not None:
+        tax_data = taxonomy_index.get(name)
+        if tax_data:
+            Tags_dict[id]['Attributes'].update(tax_data['Attributes'])
+            Tags_dict[id]['Labels'].update(tax_data['Labels'])
+            Tags_dict[id]['References'].update(tax_data['References'])
+
+    # Without an index, only the rows of this name are searched (building the index would take longer)
+    elif (Elements_df is not None) and (References_df is not None):
         name_Elements_df = Elements_df[Elements_df['name'] == name]
         if not name_Elements_df.empty:
             Tags_dict[id]['Attributes']['Type'] = name_Elements_df['type'].values[0]
@@ -145,24 +620,463 @@ def get_tag_data(element, Tags_dict, name, Elements_df=None, References_df=None,
             Tags_dict[id]['References']['Subsection'] = name_References_df['Subsection'].values[0]
 
     elif xsd_dict is not None:
-        xs_element = xsd_dict.get('xs:element')
-        xs = {}
-        for d in xs_element:
-            if d['@name'] == name:
-                xs = d
+        for xs in xsd_dict.get('xs:element', []):
+            if xs.get('@name') == name:
+                Tags_dict[id]['Attributes']['Type'] = strDetached(xs.get('@type'))
+                Tags_dict[id]['Labels']['Label'] = strDetached(xs.get('@name'))
                 break
-        if xs:
-            Tags_dict[id]['Attributes']['Type'] = strDetached(xs.get('@type'))
-            Tags_dict[id]['Labels']['Label'] = strDetached(xs.get('@name'))
 
     return id
 
 
 
+""" DOCUMENT CACHE CLASS """
+class DocumentCache():
+
+    def __init__(self, parser='html.parser', max_documents=2, measure_memory=False):
+        """
+        Cache of the parsed html and xbrl reports, so every file is read and parsed once per run and reused by
+        firmDict and GetTags (e.g. the same previously filed xbrl report for several html reports).
+
+        parser: BeautifulSoup parser backend, 'html.parser' (default), 'lxml' (faster) or 'html5lib'.
+        max_documents: number of parsed documents kept in memory. The least recently used document is released first.
+        measure_memory: if True, the peak memory of parsing every document is measured with tracemalloc (slower).
+        """
+        self.parser = parser
+        self.max_documents = max_documents
+        self.measure_memory = measure_memory
+        self.documents = OrderedDict()
+        self.stats = {}
+
+    def load(self, file_path):
+        """
+        Returns the parsed document of file_path, from the cache if the file is not modified since it was parsed.
+        """
+        key = os.path.abspath(file_path)
+        mtime = os.path.getmtime(file_path)
+        if key in self.documents and self.documents[key][0] == mtime:
+            self.documents.move_to_end(key)
+            return self.documents[key][1]
+        self.documents.pop(key, None)
+
+        start = time.perf_counter()
+        if self.measure_memory:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            # The peak is process-wide since tracing started, so it is reset to measure this parse only
+            # (tracemalloc.reset_peak needs Python 3.9, otherwise the peak is not measured if tracing was running)
+            can_measure = (not tracing) or hasattr(tracemalloc, 'reset_peak')
+            if tracing and can_measure:
+                tracemalloc.reset_peak()
+            parsed = LoadHTML(file_path, self.parser)
+            peak = tracemalloc.get_traced_memory()[1] - baseline if can_measure else None
+            if not tracing:
+                tracemalloc.stop()
+        else:
+            parsed = LoadHTML(file_path, self.parser)
+            peak = None
+
+        self.stats[key] = {'parser': self.parser,
+                        'size_mb': os.path.getsize(file_path) / 1e6,
+                        'parse_s': time.perf_counter() - start,
+                        'peak_memory_mb': peak / 1e6 if peak is not None else None}
+        if peak is not None:
+            print(f'Peak memory of parsing "{file_path}": {peak / 1e6:.1f} MB')
+
+        if self.max_documents:
+            self.documents[key] = [mtime, parsed, None]
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+
+        return parsed
+
+    def tables(self, file_path, parsed=None):
+        """
+        Returns the table model (see tableModel) of the parsed document of file_path, created once per document.
+
+        parsed: the parsed document of file_path returned by load. The table model is keyed by the elements of 
+            this document, so it must be given if the document may not be cached (max_documents=0).
+        """
+        if parsed is None:
+            parsed = self.load(file_path)
+        document = self.documents.get(os.path.abspath(file_path))
+        if (document is None) or (document[1] is not parsed):
+            # Not cached: the table model is created for this parsed document only
+            return tableModel(parsed)
+        if document[2] is None:
+            document[2] = tableModel(parsed)
+        return document[2]
+
+    def clear(self):
+        """
+        Releases all the parsed documents.
+        """
+        self.documents.clear()
+
+
+
+""" MATCH CACHE CLASS """
+class MatchCache():
+
+    def __init__(self, path=MATCH_CACHE, max_entries=1000000):
+        """
+        Persistent (SQLite) cache of the fuzzy matches of the text data, so re-tagging a mostly unchanged report
+        (e.g. an amendment or the next quarterly report) only scores the new or changed text.
+        The matches are keyed by the normalized text and a hash of the lookup dict, so a changed lookup dict
+        never returns stale matches. Texts without a match are cached as well.
+
+        path: path of the SQLite database file.
+        max_entries: maximum number of cached matches. The least recently used matches are removed first.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+
+    def connection(self):
+        # One connection per process, since SQLite connections must not be shared by forked workers
+        if (self._connection is None) or (self._pid != os.getpid()):
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS matches '
+                                    '(dict_hash TEXT, text TEXT, match TEXT, used REAL, PRIMARY KEY (dict_hash, text))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS matches_used ON matches (used)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @staticmethod
+    def dict_hash(lookup_dict, score_cutoff=95):
+        """
+        Returns a hash of the items of the lookup dict and the score cutoff.
+        """
+        h = hashlib.sha1(str(score_cutoff).encode())
+        for key, value in lookup_dict.items():
+            h.update(f'{key}\x1e{value}\x1f'.encode())
+        return h.hexdigest()
+
+    def get(self, dict_hash, strings):
+        """
+        Returns a dict of {string: matched key or None} of the cached strings.
+        """
+        cached = {}
+        strings = list(strings)
+        con = self.connection()
+        for start in range(0, len(strings), 500):
+            chunk = strings[start:start+500]
+            rows = con.execute(f'SELECT text, match FROM matches WHERE dict_hash = ? AND text IN ({",".join("?" * len(chunk))})', 
+                            [dict_hash] + chunk).fetchall()
+            cached.update(rows)
+
+        if cached:
+            with con:
+                con.executemany('UPDATE matches SET used = ? WHERE dict_hash = ? AND text = ?', 
+                                [(time.time(), dict_hash, string) for string in cached])
+        self.hits += len(cached)
+        self.misses += len(strings) - len(cached)
+        return cached
+
+    def put(self, dict_hash, matches):
+        """
+        Saves a dict of {string: matched key or None}, and removes the least recently used matches above max_entries.
+        """
+        con = self.connection()
+        now = time.time()
+        with con:
+            con.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?)', 
+                            [(dict_hash, string, match, now) for string, match in matches.items()])
+            n_entries = con.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+            if n_entries > self.max_entries:
+                con.execute('DELETE FROM matches WHERE rowid IN (SELECT rowid FROM matches ORDER BY used LIMIT ?)', 
+                            (n_entries - self.max_entries,))
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of the cache.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 
+                'misses': self.misses, 
+                'hit_rate': self.hits / total if total else None}
+
+    def clear(self):
+        """
+        Removes all the cached matches and resets the counters.
+        """
+        con = self.connection()
+        with con:
+            con.execute('DELETE FROM matches')
+        self.hits = 0
+        self.misses = 0
+
+
+
+""" PROFILER CLASS """
+class StageProfiler():
+
+    def __init__(self, sink=None):
+        """
+        Collects the wall time of the stages and the counters of a tagging run (see LookupTagger.GetTags).
+        At the end of every run the report is saved in self.last and sent to the sink.
+
+        sink: callable receiving the report of every run, e.g. print, a logger method or jsonSink(file).
+            If None, the reports are only kept in self.last.
+
+        Report: {'run': name of the run (e.g. html file), 'timings': {stage: seconds}, 'counters': {name: count}}
+        """
+        self.sink = sink
+        self.name = None
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.start = None
+        self.last = None
+
+    def begin(self, name):
+        """
+        Starts a new run, resetting the timings and the counters.
+        """
+        self.name = name
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the wall time of its block to the timings of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def end(self):
+        """
+        Ends the run and returns its report, which is also sent to the sink.
+        """
+        self.timings['total'] = time.perf_counter() - self.start
+        self.last = {'run': self.name, 'timings': dict(self.timings), 'counters': dict(self.counters)}
+        if self.sink is not None:
+            self.sink(self.last)
+        return self.last
+
+
+def jsonSink(file_path):
+    """
+    Returns a sink for StageProfiler which appends every report as a line to a json lines file.
+    """
+    def sink(report):
+        with open(file_path, 'a') as f:
+            f.write(json.dumps(report, default=str) + '\n')
+    return sink
+
+
+
+""" BATCH WORKERS """
+
+# LookupTagger shared with the worker processes of LookupTagger.iterTags
+_batch_tagger = None
+
+def _init_batch_worker(tagger):
+    """
+    Pool initializer used when processes cannot be forked: the tagger is sent once per worker, not per filing.
+    """
+    global _batch_tagger
+    _batch_tagger = tagger
+
+
+def _tag_job(job):
+    """
+    Tags one filing with the shared tagger. Errors are returned instead of raised, so one bad filing does not stop the batch.
+    Returns a dict of {'job': job index, 'html': html file, 'Tags': Tags_dict, 'error': traceback or None, 
+    'stats': profiler report of the run (see StageProfiler)}
+    """
+    n, html_FilePath, xbrl_FilePath, selected_facts, kwargs = job
+    result = {'job': n, 'html': html_FilePath, 'Tags': None, 'error': None, 'stats': None}
+    try:
+        result['Tags'] = _batch_tagger.GetTags(html_FilePath, xbrl_FilePath, selected_facts, **kwargs)
+        result['stats'] = _batch_tagger.profiler.last
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        # The parsed reports are only kept in the document cache, which is limited to max_documents
+        _batch_tagger.parsed_html = None
+    return result
+
+
+
+""" FUZZY MATCHER CLASS """
+class FuzzyMatcher():
+
+    def __init__(self, lookup_dict, score_cutoff=95, ngram_size=3, processor=utils.default_process):
+        """
+        Fuzzy matcher built once per lookup dictionary. The keys of the dictionary are indexed by their 
+        length, words and character n-grams, so only a short list of candidates is scored with fuzz.WRatio 
+        instead of all the keys.
+
+        lookup_dict: dict whose keys are the strings to be matched.
+        score_cutoff: minimum WRatio score of a match.
+        ngram_size: length of the character n-grams in the index.
+        processor: string preprocessing applied to the query and the keys before scoring
+                (rapidfuzz.utils.default_process, the default of process.extractOne in rapidfuzz 1.x and 2.x).
+
+        A WRatio score above 90 is only possible for strings with a length ratio below 1.5 whose words are 
+        a subset of one another (token_set_ratio of 100) or whose Indel ratio is above the cutoff. Every key 
+        meeting these conditions is kept in the short list, so the returned matches are the same as 
+        process.extractOne over all the keys.
+        """
+        self.keys = list(lookup_dict.keys())
+        self.values = list(lookup_dict.values())
+        self.score_cutoff = score_cutoff
+        self.ngram_size = ngram_size
+        self.processor = processor
+
+        self.processed_keys = [self._process(key) for key in self.keys]
+        self.lengths = [len(key) for key in self.processed_keys]
+
+        # Counters of the match calls, the candidates scored with fuzz.WRatio and the matches found
+        self.calls = 0
+        self.scored = 0
+        self.hits = 0
+
+        # Inverted indexes: length -> keys, word -> keys, rarest word -> keys and (n-gram, length) -> keys
+        self.length_index = defaultdict(list)
+        self.word_index = defaultdict(set)
+        self.ngram_index = defaultdict(list)
+        self.key_words = []
+        for i, key in enumerate(self.processed_keys):
+            self.key_words.append(frozenset(key.split()))
+            if not key:
+                continue
+            self.length_index[len(key)].append(i)
+            for word in self.key_words[i]:
+                self.word_index[word].add(i)
+            for gram in self._ngrams(key):
+                self.ngram_index[(gram, len(key))].append(i)
+
+        # A key whose words are all in the query always has its rarest word in the query
+        self.rare_word_index = defaultdict(list)
+        for i, words in enumerate(self.key_words):
+            if words:
+                rarest = min(words, key=lambda word: (len(self.word_index[word]), word))
+                self.rare_word_index[rarest].append(i)
+
+    def _process(self, string):
+        if self.processor is not None:
+            return self.processor(string)
+        return string
+
+    def _ngrams(self, string):
+        n = self.ngram_size
+        grams = defaultdict(int)
+        for i in range(len(string) - n + 1):
+            grams[string[i:i+n]] += 1
+        return grams
+
+    def candidates(self, query):
+        """
+        Returns the indexes (in lookup_dict order) of the keys which may score above score_cutoff.
+
+        query: the string to be matched, already preprocessed with processor.
+        """
+        if self.score_cutoff is None or self.score_cutoff <= 90:
+            return list(range(len(self.keys)))
+
+        length = len(query)
+        if not length:
+            return []
+
+        # Length filter: keys with a length ratio below 1.5
+        min_length = math.floor(length / 1.5) + 1
+        max_length = math.ceil(length * 1.5) - 1
+        lengths = self.lengths
+        key_words = self.key_words
+
+        shortlist = set()
+
+        # Keys whose words are a subset or a superset of the query words (token_set_ratio of 100)
+        words = frozenset(query.split())
+        for word in words:
+            shortlist.update(i for i in self.rare_word_index.get(word, ()) 
+                            if (min_length <= lengths[i] <= max_length) and (key_words[i] <= words))
+        if words and all(word in self.word_index for word in words):
+            rarest = min(words, key=lambda word: len(self.word_index[word]))
+            shortlist.update(i for i in self.word_index[rarest] 
+                            if (min_length <= lengths[i] <= max_length) and (words <= key_words[i]))
+
+        # Keys with an Indel ratio above score_cutoff: the length difference is at most the Indel distance,
+        # so the lengths are within a narrower range than for the token ratios
+        cutoff = self.score_cutoff / 100
+        min_ratio_length = max(min_length, math.ceil(length * cutoff / (2 - cutoff) - 1e-9))
+        max_ratio_length = min(max_length, math.floor(length * (2 - cutoff) / cutoff + 1e-9))
+
+        # Every insertion or deletion removes at most ngram_size n-grams of the query
+        max_distance = math.floor((1 - cutoff) * (length + max_ratio_length) + 1e-9)
+        min_common = length - self.ngram_size + 1 - self.ngram_size * max_distance
+        if min_common <= 0:
+            for key_length in range(min_ratio_length, max_ratio_length + 1):
+                shortlist.update(self.length_index.get(key_length, ()))
+        else:
+            # Prefix filter: a key with min_common n-grams in common contains one of the rarest n-grams
+            # of the query, so only those posting lists are read
+            grams = self._ngrams(query)
+            key_lengths = range(min_ratio_length, max_ratio_length + 1)
+            postings = {gram: [self.ngram_index.get((gram, key_length), ()) for key_length in key_lengths] 
+                        for gram in grams}
+            remaining = sum(grams.values())
+            for gram in sorted(grams, key=lambda gram: sum(len(keys) for keys in postings[gram])):
+                if remaining < min_common:
+                    break
+                for keys in postings[gram]:
+                    shortlist.update(keys)
+                remaining -= grams[gram]
+
+        return sorted(shortlist)
+
+    def match(self, string, exclude=None):
+        """
+        Returns the best match for the string as a (key, score, index) tuple, or None if no key scores 
+        above score_cutoff.
+
+        exclude: set of lookup_dict values whose keys are not matched.
+        """
+        self.calls += 1
+        query = self._process(string)
+        shortlist = self.candidates(query)
+        if exclude:
+            shortlist = [i for i in shortlist if self.values[i] not in exclude]
+        if not shortlist:
+            return None
+
+        self.scored += len(shortlist)
+        match = process.extractOne(query, [self.processed_keys[i] for i in shortlist], scorer=fuzz.WRatio, 
+                                processor=None, score_cutoff=self.score_cutoff)
+        if match:
+            self.hits += 1
+            i = shortlist[match[2]]
+            return (self.keys[i], match[1], i)
+        return None
+
+
+
 """ LOOKUP TAGGER CLASS """
 class LookupTagger():
 
-    def __init__(self, resources):
+    def __init__(self, resources, taxonomy_zip=None, cache_dir=TAXONOMY_CACHE, version='2021', parser='html.parser', 
+                max_documents=2, measure_memory=False, match_cache=None, ner_model=None, profiler=None):
         """
         This module uses the previousely filed xbrl report (html report with inline taxonomy tags) of the firm 
         along with Taxonomy resources to lookup and tag (label) the data in the desired html report. 
@@ -177,51 +1091,174 @@ class LookupTagger():
                     us-gaap-2020-01-31.xsd
                     us-roles-2020-01-31.xsd
                     us-types-2020-01-31.xsd
+        taxonomy_zip: path of a local copy of the taxonomy zip file to be used instead of downloading it ("xlsx" only).
+        cache_dir: folder where the taxonomy data ("xlsx") or the snapshot of the xsd files is cached, 
+                so it is downloaded and parsed only once. If None, the cache is not used.
+        version: taxonomy version, used as the key of the cached data.
+        parser: BeautifulSoup parser backend of the html and xbrl reports, 'html.parser' (default), 'lxml' (faster) or 'html5lib'.
+        max_documents: number of parsed reports kept in memory to be reused (see DocumentCache).
+        measure_memory: if True, the peak memory of parsing every report is measured and saved in self.documents.stats.
+        match_cache: MatchCache, or path of its SQLite file, to reuse the matches of previously tagged reports.
+                If None, the matches are not cached.
+        ner_model: trained NER model (spaCy nlp, or the path of the model saved by train_costume_NER) used to tag 
+                the narrative text blocks of the reports (see nerTags). If None, the text blocks are tagged by lookup.
+        profiler: StageProfiler collecting the timings and counters of the taxonomy load and of every GetTags run, 
+                e.g. StageProfiler(sink=print). If None, a profiler without sink is used (reports in self.profiler.last).
 
         For more explanation and example please refer to "HTML Tagger documentation" and "test_HTML_tagger.ipynb"
         """
 
         self.resources = resources
-        # If "resources" is "xlsx", the excel version of the Taxonomy data is doanloaded.
-        if resources == 'xlsx':
-            # Download the zip file contents in binary format
-            url = 'https://www.fasb.org/cs/BlobServer?blobkey=id&blobnocache=true&blobwhere=1175836290847&blobheader=application%2Fzip&blobheadername2=Content-Length&blobheadername1=Content-Disposition&blobheadervalue2=9013838&blobheadervalue1=attachment%3B+filename%3DUS_GAAP_Taxonomy_2021.zip&blobcol=urldata&blobtable=MungoBlobs'
-            r = requests.get(url)
+        self.profiler = profiler if profiler is not None else StageProfiler()
+        self.profiler.begin('taxonomy')
+        self.documents = DocumentCache(parser, max_documents, measure_memory)
+        if isinstance(match_cache, str):
+            match_cache = MatchCache(match_cache)
+        self.match_cache = match_cache
 
-            # Read the content of the zip file
-            with ZipFile(BytesIO(r.content), 'r') as zipObj:
-                file = zipObj.open(zipObj.namelist()[0])
+        # If "resources" is "xlsx", the excel version of the Taxonomy data is doanloaded (or read from the cache).
+        if resources == 'xlsx':
+            with self.profiler.stage('taxonomy_load'):
+                self.Elements_df, self.References_df = loadTaxonomyExcel(taxonomy_zip, cache_dir, version)
 
-            # Read required sheets
-            Elements_df = pd.read_excel(file, sheet_name='Elements')
-            pattern = '\[.*\]'
-            Elements_df.loc[:, 'label'] = Elements_df['label'].str.replace(pattern, '').tolist()
-            # Remove depricated taxonomy items
-            self.Elements_df = Elements_df[Elements_df['deprecatedDate'].isna()]
-            
-            self.References_df = pd.read_excel(file, sheet_name='References', header=1)
+            # Index the taxonomy data by item name
+            self.taxonomy_index = taxonomyIndex(Elements_df=self.Elements_df, References_df=self.References_df)
 
-            self.taxonomy = file
+            # Lookup dict of the taxonomy labels {label: name}
+            taxonomy_dict = dict(self.Elements_df[['label', 'name']].to_records(index=False))
 
-            print(f'Taxonomy excel file downloaded.')
+            self.taxonomy = taxonomy_zip if taxonomy_zip is not None else TAXONOMY_URL
 
-        # If "resources" is a folder path, all .xsd files are returned a dict object containing all the data.
+        # If "resources" is a folder path, the elements of all .xsd files are returned as a dict object (or read from the snapshot).
         else:
-            # List all .xsd files
-            all_files = glob.glob(self.resources + '/*.xsd')
-
-            xsd_dict = {}
-            # Read all file contents
-            for f in all_files:
-                xsd_f = xmlschema.XMLSchema(f)
-                xsd_dict.update(xsd_f.to_dict(f))
+            with self.profiler.stage('taxonomy_load'):
+                xsd_dict = loadTaxonomyXSD(self.resources, cache_dir)
 
             self.taxonomy = xsd_dict
+            self.Elements_df = None
+            self.References_df = None
+
+            # Index the taxonomy data by item name
+            self.taxonomy_index = taxonomyIndex(xsd_dict=xsd_dict)
+
+            # Lookup dict of the taxonomy labels {label: name}
+            taxonomy_dict = {data['Labels']['Label']: name for name, data in self.taxonomy_index.items()}
 
             print(f'Taxonomy resources loaded from: {self.resources}')     
 
+        self.taxonomy_dict = {label: name for label, name in taxonomy_dict.items() if isinstance(label, str)}
+        self.taxonomy_matcher = None
+        self.ner_model = ner_model
+        self.ner_nlp = None
+
+        self.profiler.count('taxonomy_items', len(self.taxonomy_index))
+        self.profiler.count('taxonomy_labels', len(self.taxonomy_dict))
+        self.profiler.end()
 
-    def GetTags(self, html_FilePath, xbrl_FilePath, selected_facts=None):
+
+    def nerModel(self):
+        """
+        Returns the spaCy model of the NER tagger, which is loaded once on first use.
+        """
+        if self.ner_nlp is None:
+            if isinstance(self.ner_model, str):
+                import spacy
+                from NERmodel_trainer import register_FuzzyLabelRuler
+
+                # The model may have been saved with the fuzzy_label_ruler
+                register_FuzzyLabelRuler()
+                self.ner_nlp = spacy.load(self.ner_model)
+                print(f"Loaded NER model: {self.ner_model}")
+            else:
+                self.ner_nlp = self.ner_model
+        return self.ner_nlp
+
+
+    def nerTags(self, blocks, Tags_dict, batch_size=64, n_process=1):
+        """
+        Tags the entities found by the NER model in the narrative text blocks (see textBlocks), and adds them 
+        to Tags_dict with get_tag_data. The label of an entity is its tag name.
+        The tags have the text of the entity as "Fact" and its (start, end) position in the block text as "Span".
+
+        batch_size: number of text blocks per nlp.pipe batch.
+        n_process: number of processes used by nlp.pipe (must be 1 in the worker processes of iterTags).
+        """
+        nlp = self.nerModel()
+        # Only the NER (and the components it may use) is run
+        disabled = [pipe for pipe in nlp.pipe_names if pipe in ('tagger', 'parser', 'attribute_ruler', 'lemmatizer', 
+                                                                'senter', 'sent_start_rule')]
+        texts = [block['text'] for block in blocks]
+        docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=disabled)
+        for block, doc in zip(blocks, docs):
+            for ent in doc.ents:
+                id = get_tag_data(block['element'], Tags_dict, ent.label_, taxonomy_index=self.taxonomy_index, 
+                                position=ent.start_char)
+                Tags_dict[id]['Attributes']['Fact'] = ent.text
+                Tags_dict[id]['Attributes']['Span'] = (ent.start_char, ent.end_char)
+
+        return Tags_dict
+
+
+    def taxonomyMatcher(self):
+        """
+        Returns the FuzzyMatcher of the taxonomy labels (taxonomy_dict), which is built once on first use.
+        """
+        if self.taxonomy_matcher is None:
+            self.taxonomy_matcher = FuzzyMatcher(self.taxonomy_dict)
+        return self.taxonomy_matcher
+
+
+    def matchStrings(self, strings, lookup_dict, batch=False, workers=-1, matcher=None, exclude=None):
+        """
+        Finds the best matches of the strings in lookup_dict, using the match cache if there is one.
+        Returns a dict of {string: matched key} for the strings having a match.
+
+        batch: if True, the strings are matched with batch_match, otherwise with a FuzzyMatcher of lookup_dict.
+        matcher: FuzzyMatcher to be used instead, e.g. taxonomyMatcher, with the values in exclude not matched.
+                lookup_dict must then be the lookup dict of the matcher without the excluded values.
+        """
+        strings = list(dict.fromkeys(strings))
+
+        cached = {}
+        if self.match_cache is not None:
+            dict_hash = MatchCache.dict_hash(lookup_dict)
+            cached = {string: match for string, match in self.match_cache.get(dict_hash, strings).items() 
+                    if (match is None) or (match in lookup_dict)}
+            strings = [string for string in strings if string not in cached]
+            self.profiler.count('match_cache_hits', len(cached))
+
+        if matcher is not None:
+            scored = matcher.scored
+            matches = {}
+            for string in strings:
+                match = matcher.match(string, exclude=exclude)
+                if match:
+                    matches[string] = match[0]
+            self.profiler.count('match_scored', matcher.scored - scored)
+        elif batch:
+            matches = batch_match(strings, lookup_dict, workers=workers)
+            self.profiler.count('match_scored', len(strings) * len(lookup_dict))
+        else:
+            matcher = FuzzyMatcher(lookup_dict)
+            matches = {}
+            for string in strings:
+                match = matcher.match(string)
+                if match:
+                    matches[string] = match[0]
+            self.profiler.count('match_scored', matcher.scored)
+
+        self.profiler.count('match_calls', len(strings))
+        self.profiler.count('match_hits', len(matches))
+
+        if self.match_cache is not None:
+            self.match_cache.put(dict_hash, {string: matches.get(string) for string in strings})
+
+        matches.update((string, match) for string, match in cached.items() if match is not None)
+        return matches
+
+
+    def GetTags(self, html_FilePath, xbrl_FilePath, selected_facts=None, batch=False, workers=-1, taxonomy_labels=True, 
+                min_words=8, ner_batch_size=64, ner_processes=1):
         """
         Creates a lookup dict from tagged monetary data in tables and the firm specific facts in previously filed xbrl report, and US-GAAP Taxonomy resources. 
         Then the desired html report is scanned for the lookup data and the tags are returned.
@@ -229,73 +1266,261 @@ class LookupTagger():
         html_FilePath: file directory of the .html file to be tagged.
         xbrl_FilePath: file path of the previously filed xbrl report.
         selected_facts: list of fim specific fact for which the values from previously filed xbrl report is used for lookup.
+        batch: if True, all the text data of the html report is matched in one vectorized pass (see batch_match),
+                otherwise every text is matched one at a time with FuzzyMatcher. The returned tags are the same.
+        workers: number of threads used in batch mode. -1 uses all the available cores.
+        taxonomy_labels: if True, the text data not found in the lookup dicts is matched with the labels 
+                of the taxonomy items not in the firm specific facts (taxDict), using the index of taxonomyMatcher.
+
+        The matches are reused from self.match_cache if the tagger has a match cache (see MatchCache).
+
+        If the tagger has a NER model, the narrative text blocks (with at least min_words words, not in tables) are 
+        tagged by the NER model (see nerTags, ner_batch_size and ner_processes), and the other text data by lookup.
+
+        The timings and counters of the stages of the run are saved in self.profiler.last (see StageProfiler).
         """
+        profiler = self.profiler
+        profiler.begin(html_FilePath)
 
         # Create a lookup dictionary from previously filed xbrl report
-        self.firmDict = firmDict(xbrl_FilePath, selected_facts)
+        with profiler.stage('firm_dict'):
+            self.firmDict = firmDict(xbrl_FilePath, selected_facts, self.documents)
         tables_dict = self.firmDict[0]
         firm_dict = self.firmDict[1]
+        profiler.count('tables_dict', len(tables_dict))
+        profiler.count('firm_dict', len(firm_dict))
 
         # Create a dict from taxonomy items not in the firmDict, from resources
-        self.taxDict = {}
-        if self.resources == 'xlsx':
-            taxonomy_dict = dict(self.Elements_df[['label', 'name']].to_records(index=False))
-
-            for item in taxonomy_dict:
-                if taxonomy_dict[item] not in firm_dict.values():
-                    self.taxDict[item] = taxonomy_dict[item]
+        firm_names = set(firm_dict.values())
+        self.taxDict = {label: name for label, name in self.taxonomy_dict.items() if name not in firm_names}
 
 
         # Load the HTML file to be tagged
-        self.parsed_html = LoadHTML(html_file = html_FilePath)
+        with profiler.stage('html_parse'):
+            self.parsed_html = self.documents.load(html_FilePath)
+            table_rows = self.documents.tables(html_FilePath, self.parsed_html)
+
+        with profiler.stage('text_data'):
+            # The narrative text blocks are left to the NER model
+            blocks, text_blocks = [], {}
+            if self.ner_model is not None:
+                blocks, text_blocks = textBlocks(self.parsed_html, table_rows, min_words)
+
+            # Collect the text data of the HTML report
+            html_data = []
+            for elmnt in self.parsed_html.body.find_all():
+                if elmnt.string and not textBlock(text_blocks, elmnt):
+                    # Remove unicode strings and HTML characters
+                    string = remove_unicode(elmnt.string).strip()
+                    if string and (not string.isspace()):
+                        html_data.append((elmnt, string))
+        profiler.count('text_data', len(html_data))
+
+        # Find the best matches of the text data in tables_dict, then in firm_dict and in the taxonomy labels
+        # for the text data not matched before
+        with profiler.stage('matching'):
+            strings = [string for _, string in html_data]
+            tables_matches = self.matchStrings(strings, tables_dict, batch, workers)
+            strings = [string for string in strings if string not in tables_matches]
+            firm_matches = self.matchStrings(strings, firm_dict, batch, workers)
+            taxonomy_matches = {}
+            if taxonomy_labels:
+                strings = [string for string in strings if string not in firm_matches]
+                taxonomy_matches = self.matchStrings(strings, self.taxDict, matcher=self.taxonomyMatcher(), exclude=firm_names)
 
         # Search for the lookup dictionaries' items in the text data of HTML report
         Tags_dict = {}
+        tagging_start = time.perf_counter()
 
         # First search tables for monetary data
-        money_pattern = '\s*\(?(\d+(,\d+)+)\)?\s*' #pattern to match monetary values
-        html_data = self.parsed_html.body.find_all()
-        for elmnt in html_data:
-            if elmnt.string:
+        tagged_rows = set()
+        for elmnt, string in html_data:
+            # Find the best match for the text data in tables_dict
+            match = tables_matches.get(string)
+            if match is not None:
+                name = tables_dict[match]
+                id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                fact = string
+                Tags_dict[id]['Attributes']['Fact'] = fact
+                
+                # Generate tag data for monetary values in the table row (once per row)
+                tbl_row = tableRow(table_rows, elmnt)
+                if tbl_row and (tbl_row['index'] not in tagged_rows):
+                    tagged_rows.add(tbl_row['index'])
+                    for st, value, sign in tbl_row['cells']:
+                        id = get_tag_data(st, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+
+                        # Save monetary value as numeric, not text
+                        Tags_dict[id]['Attributes']['Fact'] = value
+                        Tags_dict[id]['Attributes']['Sign'] = sign
+                
+            else:
+                # Find the best match for the text data in firm_dict
+                match = firm_matches.get(string)
+                if match is not None:
+                    name = firm_dict[match]
+                    id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                    fact = string
+                    Tags_dict[id]['Attributes']['Fact'] = fact
+
+                else:
+                    # Find the best match for the text data in the taxonomy labels (taxDict)
+                    match = taxonomy_matches.get(string)
+                    if match is not None:
+                        name = self.taxDict[match]
+                        id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                        Tags_dict[id]['Attributes']['Fact'] = string
+
+        profiler.timings['tagging'] += time.perf_counter() - tagging_start
+        profiler.count('lookup_tags', len(Tags_dict))
+
+        # Tag the entities in the narrative text blocks
+        if blocks:
+            with profiler.stage('ner'):
+                self.nerTags(blocks, Tags_dict, ner_batch_size, ner_processes)
+            profiler.count('text_blocks', len(blocks))
+            profiler.count('ner_tags', len(Tags_dict) - profiler.counters['lookup_tags'])
+
+        profiler.count('tags', len(Tags_dict))
+        with profiler.stage('output_size'):
+            profiler.count('output_bytes', len(json.dumps(Tags_dict, default=str)))
+        profiler.end()
+
+        return Tags_dict
+
+
+    def iterTags(self, jobs, processes=None, **kwargs):
+        """
+        Tags a batch of filings in parallel and yields the result of every filing as soon as it is ready (in completion order).
+        The taxonomy is loaded once in this tagger and shared with the worker processes by fork, so it is not pickled per filing.
+        Yields a dict of {'job': index of the job, 'html': html file, 'Tags': Tags_dict, 'error': traceback or None, 
+        'stats': profiler report of the filing (see StageProfiler)}
+
+        jobs: list of (html_FilePath, xbrl_FilePath, selected_facts) tuples. selected_facts may be omitted.
+        processes: number of worker processes. None uses all the available cores, 1 tags the filings in this process.
+        kwargs: other arguments of GetTags, e.g. batch=True. In batch mode every process uses 1 thread (workers=1) by default.
+        """
+        global _batch_tagger
+
+        if kwargs.get('batch'):
+            kwargs.setdefault('workers', 1)
+
+        # Build the index of the taxonomy labels (and load the NER model) before the workers are forked, so it is shared
+        if kwargs.get('taxonomy_labels', True):
+            self.taxonomyMatcher()
+        if self.ner_model is not None:
+            self.nerModel()
+
+        tasks = []
+        for n, job in enumerate(jobs):
+            html_FilePath, xbrl_FilePath, *selected_facts = job
+            selected_facts = selected_facts[0] if selected_facts else None
+            tasks.append((n, html_FilePath, xbrl_FilePath, selected_facts, kwargs))
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(tasks))
+
+        if processes <= 1:
+            _batch_tagger = self
+            for task in tasks:
+                yield _tag_job(task)
+            return
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # Forked workers inherit the tagger from the parent process memory
+            _batch_tagger = self
+            pool = multiprocessing.get_context('fork').Pool(processes)
+        else:
+            pool = multiprocessing.Pool(processes, initializer=_init_batch_worker, initargs=(self,))
+
+        with pool:
+            for result in pool.imap_unordered(_tag_job, tasks, chunksize=1):
+                yield result
+
+
+    def GetTagsBatch(self, jobs, processes=None, **kwargs):
+        """
+        Tags a batch of filings in parallel (see iterTags) and returns the list of results in the order of jobs.
+        Filings which failed have 'Tags' None and the traceback in 'error'.
+        """
+        results = [None] * len(jobs)
+        for result in self.iterTags(jobs, processes, **kwargs):
+            results[result['job']] = result
+        return results
+
+
+    def streamTags(self, html_FilePath, xbrl_FilePath, selected_facts=None, taxonomy_labels=True):
+        """
+        Low-memory version of GetTags for very large html reports. The report is read incrementally (see iterHTML), 
+        only the current table row is kept in memory, and the tags are yielded one at a time instead of being 
+        collected in one Tags_dict. The previously filed xbrl report is parsed once to build the lookup dictionaries 
+        and is not cached in documents.
+        Yields (id, tag data) tuples, e.g. to be written to a json lines file.
+
+        The tags are the same as GetTags, but the ids of the tags not having an "id" attribute use the position 
+        of the element in the document instead of its column, and the tags are yielded in reading order.
+        """
+
+        # Create a lookup dictionary from previously filed xbrl report
+        # (the soup of the xbrl report is not kept in the document cache, so that only the lookup dictionaries stay in memory)
+        self.firmDict = firmDict(xbrl_FilePath, selected_facts)
+        tables_dict = self.firmDict[0]
+        firm_dict = self.firmDict[1]
+
+        # Build the fuzzy matchers of the lookup dictionaries
+        tables_matcher = FuzzyMatcher(tables_dict)
+        firm_matcher = FuzzyMatcher(firm_dict)
+        firm_names = set(firm_dict.values())
+        if taxonomy_labels:
+            taxonomy_matcher = self.taxonomyMatcher()
+
+        for elements, row in iterHTML(html_FilePath):
+            row_tagged = False
+            for elmnt in elements:
                 # Remove unicode strings and HTML characters
                 string = remove_unicode(elmnt.string).strip()
-                if string and (not string.isspace()):
-
-                    # Find the best match for the text data in tables_dict
-                    match = process.extractOne(string, tables_dict.keys(), scorer=fuzz.WRatio)
-                    if match and (match[1] >= 95):
-                        
-                        name = tables_dict[match[0]]
-                        id = get_tag_data(elmnt, Tags_dict, name, self.Elements_df, self.References_df)
-                        fact = string
-                        Tags_dict[id]['Attributes']['Fact'] = fact
-                        
-                        # Generate tag data for monetary values in tables
-                        if elmnt.find_parent('tr'):
-                            for st in elmnt.find_parent('tr'):
-                                if (st.string) and (not st.string.isspace()):
-                                    # Check if the fact is a monetary value
-                                    if re.fullmatch(pattern=money_pattern, string=st.string):                                    
-                                        id = get_tag_data(st, Tags_dict, name, self.Elements_df, self.References_df)
-
-                                        # Save monetary value as numeric, not text
-                                        fact = int(re.sub(pattern='\(|\)|,|\s', repl='', string=st.string))
-                                        Tags_dict[id]['Attributes']['Fact'] = fact
-
-                                        if st.string.startswith('('):
-                                            sign = 'Negative'
-                                        else:
-                                            sign = 'Positive'
-                                        Tags_dict[id]['Attributes']['Sign'] = sign
-                        
-                    else:
-                        # Find the best match for the text data in firm_dict
-                        match = process.extractOne(string, firm_dict.keys(), scorer=fuzz.WRatio)
-                        if match and (match[1] >= 95):
-                            name = firm_dict[match[0]]
-                            id = get_tag_data(elmnt, Tags_dict, name, self.Elements_df, self.References_df)
-                            fact = string
-                            Tags_dict[id]['Attributes']['Fact'] = fact
-
-
-        return Tags_dict
\ No newline at end of file
+                if not string or string.isspace():
+                    continue
+
+                Tags_dict = {}
+
+                # Find the best match for the text data in tables_dict
+                match = tables_matcher.match(string)
+                if match:
+                    name = tables_dict[match[0]]
+                    id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                    Tags_dict[id]['Attributes']['Fact'] = string
+
+                    # Generate tag data for monetary values in the row (once per row)
+                    if row and not row_tagged:
+                        row_tagged = True
+                        for st in row:
+                            if (st.string) and (not st.string.isspace()):
+                                # Check if the fact is a monetary value
+                                money = parse_money(st.string)
+                                if money:
+                                    id = get_tag_data(st, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+
+                                    # Save monetary value as numeric, not text
+                                    Tags_dict[id]['Attributes']['Fact'] = money[0]
+                                    Tags_dict[id]['Attributes']['Sign'] = money[1]
+
+                else:
+                    # Find the best match for the text data in firm_dict
+                    match = firm_matcher.match(string)
+                    if match:
+                        name = firm_dict[match[0]]
+                        id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                        Tags_dict[id]['Attributes']['Fact'] = string
+
+                    elif taxonomy_labels:
+                        # Find the best match for the text data in the taxonomy labels
+                        match = taxonomy_matcher.match(string, exclude=firm_names)
+                        if match:
+                            name = self.taxonomy_dict[match[0]]
+                            id = get_tag_data(elmnt, Tags_dict, name, taxonomy_index=self.taxonomy_index)
+                            Tags_dict[id]['Attributes']['Fact'] = string
+
+                for record in Tags_dict.items():
+                    yield record
@@ -1,13 +1,17 @@
 import re
+import os
+import time
 import random
+import hashlib
 import pickle
+import json
+from bisect import bisect_left, bisect_right
 from pathlib import Path
+from rapidfuzz import fuzz
+from rapidfuzz import process
+from rapidfuzz import utils
 
-# Import NLP libraries
-import spacy
-from spacy.training import Example
-from spacy.language import Language
-from spaczz.pipeline import SpaczzRuler
+# The NLP libraries (spacy and spaczz) are imported in the functions using them, as they take seconds to import
 
 
 def remove_unicode(string):
@@ -33,14 +37,79 @@ def sent_generator(train_text, model):
     return train_sent
 
 
-def add_pipe_SpaczzRuler(Labels, model):
+# Pipeline components used to find the sentence boundaries (the other components are disabled in stream_sents)
+SENT_COMPONENTS = ('tok2vec', 'sent_start_rule', 'parser', 'senter', 'sentencizer')
+
+def text_chunks(texts, chunk_size=100000):
+    """
+    This function splits the documents into chunks of about chunk_size characters at line ends, 
+    so no chunk exceeds the max_length of the spaCy model.
+
+    texts: path of a text file, or iterable of documents (str)
+    """
+    if isinstance(texts, (str, Path)):
+        texts = [open(texts, 'r')] if os.path.isfile(texts) else [str(texts)]
+
+    for text in texts:
+        # A document is read line by line (str.splitlines or the lines of a file)
+        lines = text.splitlines(keepends=True) if isinstance(text, str) else text
+        chunk, size = [], 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk)
+        if hasattr(lines, 'close'):
+            lines.close()
+
+
+def stream_sents(texts, model, chunk_size=100000, batch_size=8, n_process=1):
+    """
+    This function yields the unique sentences of the training text data without loading all the data 
+    in one Doc. The text is split into chunks (see text_chunks), which are passed through nlp.pipe with 
+    only the components needed for the sentence boundaries.
+    The yielded sentences are deduplicated with a set of 8-byte hashes instead of the sentences.
+
+    texts: path of a text file, or iterable of documents (str)
+    model: spaCy nlp model
+    chunk_size: maximum number of characters of a chunk (approximately, chunks are split at line ends).
+    batch_size: number of chunks per nlp.pipe batch.
+    n_process: number of processes used by nlp.pipe.
+    """
+    regex = re.compile(r'(\s+$)|([^\S]\n+)') # Match and remove empty sentences
+
+    if not any(pipe in model.pipe_names for pipe in SENT_COMPONENTS[1:]):
+        # Models without a parser need a rule-based sentence splitter
+        model.add_pipe('sentencizer')
+    other_pipes = [pipe for pipe in model.pipe_names if pipe not in SENT_COMPONENTS]
+
+    chunks = (remove_unicode(chunk) for chunk in text_chunks(texts, chunk_size))
+    seen = set()
+    for doc in model.pipe(chunks, batch_size=batch_size, n_process=n_process, disable=other_pipes):
+        for sent in doc.sents:
+            if regex.match(sent.text):
+                continue
+            key = hashlib.blake2b(sent.text.encode(), digest_size=8).digest()
+            if key not in seen:
+                seen.add(key)
+                yield sent.text
+
+
+def add_pipe_SpaczzRuler(Labels, model, in_pipeline=False):
     """
     This function adds the spaczz_ruler, which is a fuzzy matcher, to the NLP pipeline.
 
     Labels: DataFrame with 2 columns. The first columen is the NER label, and the 
         second column is the patern to be matched.
     model: spaCy nlp model
+    in_pipeline: if True, the spaczz_ruler is added to the pipeline even if the model has no NER
+        (required to run it with nlp.pipe).
     """
+    from spaczz.pipeline import SpaczzRuler
+
     patterns = []
 
     for rec in Labels.to_records(index=False):
@@ -53,6 +122,8 @@ def add_pipe_SpaczzRuler(Labels, model):
 
     if 'ner' in model.pipe_names:
         spaczz_ruler = model.add_pipe("spaczz_ruler", after='ner')
+    elif in_pipeline:
+        spaczz_ruler = model.add_pipe("spaczz_ruler", last=True)
     else:
         spaczz_ruler = SpaczzRuler(model)
     spaczz_ruler.add_patterns(patterns)
@@ -60,15 +131,191 @@ def add_pipe_SpaczzRuler(Labels, model):
     return spaczz_ruler
 
 
+class FuzzyLabelRuler():
+
+    def __init__(self, nlp, name='fuzzy_label_ruler', min_r=90):
+        """
+        Fuzzy matcher of the labels patterns, an alternative to the spaczz_ruler which is built once and 
+        saved with the model (nlp.to_disk). The patterns are grouped by number of tokens and sorted by length, 
+        so every span of the doc is only scored (fuzz.ratio) against the patterns of its number of tokens 
+        whose length allows a score >= min_r.
+
+        nlp: spaCy nlp model, used to tokenize the patterns
+        min_r: minimum fuzz.ratio score (0-100) of a match.
+        """
+        self.nlp = nlp
+        self.name = name
+        self.min_r = min_r
+        self.patterns = []
+        # {number of tokens: {processed pattern: label}}
+        self.pattern_labels = {}
+        # {number of tokens: (pattern lengths, processed patterns, labels)} sorted by pattern length
+        self.groups = {}
+
+    def add_patterns(self, patterns):
+        """
+        patterns: list of {'label': label, 'pattern': pattern}
+        """
+        for pattern in patterns:
+            key = utils.default_process(pattern['pattern'])
+            if not key:
+                continue
+            n_tokens = len(self.nlp.make_doc(pattern['pattern']))
+            group = self.pattern_labels.setdefault(n_tokens, {})
+            # The first label of a duplicated pattern is kept
+            if key not in group:
+                group[key] = pattern['label']
+                self.patterns.append({'label': pattern['label'], 'pattern': pattern['pattern']})
+
+        self.groups = {}
+        for n_tokens, group in self.pattern_labels.items():
+            rows = sorted((len(key), key, label) for key, label in group.items())
+            self.groups[n_tokens] = ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+    def __call__(self, doc):
+        from spacy.tokens import Span
+        from spacy.util import filter_spans
+
+        r = self.min_r / 100
+        matches = []
+        for n_tokens, (lengths, texts, labels) in self.groups.items():
+            for start in range(len(doc) - n_tokens + 1):
+                end = start + n_tokens
+                # Spans starting or ending with punctuation or white space are not matched
+                if doc[start].is_punct or doc[start].is_space or doc[end-1].is_punct or doc[end-1].is_space:
+                    continue
+                span_text = utils.default_process(doc[start:end].text)
+                length = len(span_text)
+                # Only the patterns whose length allows a fuzz.ratio >= min_r are scored
+                lo = bisect_left(lengths, length * r / (2 - r) - 1e-9)
+                hi = bisect_right(lengths, length * (2 - r) / r + 1e-9)
+                if lo >= hi:
+                    continue
+                match = process.extractOne(span_text, texts[lo:hi], scorer=fuzz.ratio, processor=None, 
+                                        score_cutoff=self.min_r)
+                if match:
+                    matches.append((match[1], n_tokens, start, labels[lo + match[2]]))
+
+        # The best (then longest) matches are kept, without overlapping the other matches or entities
+        matches.sort(key=lambda m: (-m[0], -m[1], m[2]))
+        taken = set(i for ent in doc.ents for i in range(ent.start, ent.end))
+        spans = []
+        for score, n_tokens, start, label in matches:
+            if taken.isdisjoint(range(start, start + n_tokens)):
+                spans.append(Span(doc, start, start + n_tokens, label=label))
+                taken.update(range(start, start + n_tokens))
+
+        doc.ents = filter_spans(list(doc.ents) + spans)
+        return doc
+
+    def pipe(self, docs, batch_size=128):
+        for doc in docs:
+            yield self(doc)
+
+    def to_bytes(self, exclude=tuple()):
+        return json.dumps({'min_r': self.min_r, 'patterns': self.patterns}).encode()
+
+    def from_bytes(self, data, exclude=tuple()):
+        cfg = json.loads(data)
+        self.min_r = cfg['min_r']
+        self.patterns, self.pattern_labels = [], {}
+        self.add_patterns(cfg['patterns'])
+        return self
+
+    def to_disk(self, path, exclude=tuple()):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / 'patterns.json', 'wb') as fp:
+            fp.write(self.to_bytes())
+
+    def from_disk(self, path, exclude=tuple()):
+        with open(Path(path) / 'patterns.json', 'rb') as fp:
+            return self.from_bytes(fp.read())
+
+
+def register_FuzzyLabelRuler():
+    """
+    This function registers the "fuzzy_label_ruler" pipeline component in spaCy. It must be called 
+    before loading a model saved with the component.
+    """
+    from spacy.language import Language
+
+    if not Language.has_factory('fuzzy_label_ruler'):
+        Language.factory('fuzzy_label_ruler', default_config={'min_r': 90}, 
+                        func=lambda nlp, name, min_r: FuzzyLabelRuler(nlp, name, min_r))
+
+
+def add_pipe_FuzzyLabelRuler(Labels, model, min_r=90):
+    """
+    This function adds the fuzzy_label_ruler (see FuzzyLabelRuler) to the NLP pipeline.
+
+    Labels: DataFrame with 2 columns. The first columen is the NER label, and the 
+        second column is the patern to be matched.
+    model: spaCy nlp model
+    min_r: minimum fuzz.ratio score (0-100) of a match.
+    """
+    register_FuzzyLabelRuler()
+
+    patterns = [{'label': rec[0], 'pattern': rec[1]} for rec in Labels.to_records(index=False)]
+
+    if 'ner' in model.pipe_names:
+        ruler = model.add_pipe('fuzzy_label_ruler', after='ner', config={'min_r': min_r})
+    else:
+        ruler = model.add_pipe('fuzzy_label_ruler', last=True, config={'min_r': min_r})
+    ruler.add_patterns(patterns)
+
+    return ruler
+
+
+# Names of the label rulers (pipeline components) used by build_TrainData.TrainData
+RULERS = ('spaczz_ruler', 'fuzzy_label_ruler')
+
+def build_LabelRuler(Labels, model=None, ruler='fuzzy_label_ruler', output_dir=None):
+    """
+    This function adds the label ruler to a spaCy model once, so it can be saved with the model and 
+    reused by build_TrainData (build_TrainData(train_text, model=output_dir)) without building the patterns again.
+
+    Labels: DataFrame with 2 columns. The first columen is the NER label, and the 
+        second column is the patern to be matched.
+    model: spaCy language model. If None, a blank 'en' model is used.
+    ruler: 'fuzzy_label_ruler' (see FuzzyLabelRuler) or 'spaczz_ruler'
+    output_dir: path to save the model with the ruler
+    """
+    import spacy
+
+    register_FuzzyLabelRuler()
+    nlp = spacy.load(model) if model is not None else spacy.blank('en')
+
+    if ruler == 'fuzzy_label_ruler':
+        add_pipe_FuzzyLabelRuler(Labels, nlp)
+    else:
+        add_pipe_SpaczzRuler(Labels, nlp, in_pipeline=True)
+
+    if output_dir is not None:
+        nlp.to_disk(Path(output_dir))
+        print(f"Saved model with {ruler} to ", output_dir)
+
+    return nlp
+
+
 class build_TrainData:
 
-    def __init__(self, train_text, model=None):
+    def __init__(self, train_text, model=None, stream=False, chunk_size=100000, n_process=1):
         """
         Create training data in the format required to train a NER pipeline using spaCy.
 
         train_text: plain text data to be used for training a custom NER model
+            If stream is True, it can also be the path of a text file or an iterable of documents.
         model: spaCy language model
+        stream: if True, the sentences are read lazily with stream_sents while TrainData runs, instead of 
+            parsing the whole text at once (for large corpora). The sentences can then be used only once.
+        chunk_size, n_process: see stream_sents
         """
+        import spacy
+        from spacy.language import Language
+
+        # A saved model may include the fuzzy_label_ruler
+        register_FuzzyLabelRuler()
 
         if model is not None:
             nlp = spacy.load(model)
@@ -90,32 +337,61 @@ class build_TrainData:
             nlp.add_pipe('sent_start_rule', before='parser')
 
         self.model = nlp
-        self.train_sents = sent_generator(train_text, nlp)
+        if stream:
+            self.train_sents = stream_sents(train_text, nlp, chunk_size=chunk_size, n_process=n_process)
+        else:
+            self.train_sents = sent_generator(train_text, nlp)
 
 
-    def TrainData(self, labels, verbose=True, save_results=True):
+    def TrainData(self, labels, verbose=True, save_results=True, batch_size=None, n_process=1, 
+                checkpoint_file="NER_Train_Data.jsonl", ruler='spaczz_ruler'):
         """
         This function creates the training data in the format required for SpaCy.
         
         labels: DataFrame with 2 columns. The first columen is the NER label, and the 
             second column is the patern to be matched.
+        batch_size: if set (or if n_process > 1), the sentences are annotated in batches of batch_size 
+            with nlp.pipe, running only the spaczz_ruler.
+        n_process: number of processes used by nlp.pipe to annotate the sentences.
+        checkpoint_file: JSONL file to which the new training samples are appended every 50 sentences 
+            (see load_TrainData). The final training data is also saved in "NER_Train_Data.txt" (pickle).
+        ruler: label ruler added to the model, 'spaczz_ruler' or 'fuzzy_label_ruler' (see FuzzyLabelRuler). 
+            If the model already has a ruler (see build_LabelRuler), it is reused.
         """
+        batched = (batch_size is not None) or (n_process > 1)
 
         # Add SpaczzRuler, fuzzy token matcher, to nlp pipeline
-        if 'spaczz_ruler' not in self.model.pipe_names:
-            spaczz_ruler = add_pipe_SpaczzRuler(labels, self.model)
+        rulers = [pipe for pipe in self.model.pipe_names if pipe in RULERS]
+        if rulers:
+            ruler = rulers[0]
+            spaczz_ruler = self.model.get_pipe(ruler)
+        elif ruler == 'fuzzy_label_ruler':
+            spaczz_ruler = add_pipe_FuzzyLabelRuler(labels, self.model)
+        else:
+            spaczz_ruler = add_pipe_SpaczzRuler(labels, self.model, in_pipeline=batched)
 
         # Match labels to every sentence in the train_text
-        Train_Data = []
-        for n, sent in enumerate(self.train_sents):
-            doc = self.model.make_doc(sent)
-            doc = spaczz_ruler(doc)
+        if batched:
+            other_pipes = [pipe for pipe in self.model.pipe_names if pipe != ruler]
+            docs = self.model.pipe(self.train_sents, batch_size=batch_size or 64, n_process=n_process, 
+                                disable=other_pipes)
+        else:
+            docs = (spaczz_ruler(self.model.make_doc(sent)) for sent in self.train_sents)
+
+        label_set = set(labels.iloc[:, 1].tolist())
+
+        if save_results:
+            # Start a new checkpoint file
+            open(checkpoint_file, 'w').close()
 
+        Train_Data = []
+        n_saved = 0
+        for n, doc in enumerate(docs):
             entities = [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents 
-                        if ent.label_ in labels.iloc[:, 1].tolist()]
+                        if ent.label_ in label_set]
 
             if entities:
-                inst = (sent, {'entities': entities})
+                inst = (doc.text, {'entities': entities})
                 Train_Data.append(inst)
 
             if verbose:
@@ -124,10 +400,12 @@ class build_TrainData:
 
             if save_results:
                 if n%50 == 0:
-                    with open("NER_Train_Data.txt", "wb") as fp:
-                        pickle.dump(Train_Data, fp)
+                    # Only the samples created since the last checkpoint are written
+                    append_TrainData(Train_Data[n_saved:], checkpoint_file)
+                    n_saved = len(Train_Data)
                     
         if save_results:
+            append_TrainData(Train_Data[n_saved:], checkpoint_file)
             with open("NER_Train_Data.txt", "wb") as fp:
                 pickle.dump(Train_Data, fp)
 
@@ -136,18 +414,92 @@ class build_TrainData:
         return Train_Data
         
 
-def train_costume_NER(train_data, model=None, n_iter=50, batch=None, output_dir=None):
+def append_TrainData(train_data, file_path):
+    """
+    This function appends training samples to a JSONL file, one (text, {'entities': [...]}) sample per line.
+    """
+    if not train_data:
+        return
+    with open(file_path, 'a', encoding='utf-8') as fp:
+        for text, annotations in train_data:
+            fp.write(json.dumps([text, annotations]) + '\n')
+
+
+def load_TrainData(file_path):
+    """
+    This function reads the training samples saved in a JSONL file by build_TrainData.TrainData.
+    """
+    train_data = []
+    with open(file_path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            text, annotations = json.loads(line)
+            annotations['entities'] = [tuple(ent) for ent in annotations['entities']]
+            train_data.append((text, annotations))
+    return train_data
+
+
+def TrainData_to_DocBin(train_data, model=None, output_file=None):
+    """
+    This function converts the training data to a spaCy DocBin (the entities are aligned to the tokens once).
+    Entities which do not match token boundaries are dropped.
+
+    train_data: custom entity training data, list of (text, {'entities': [(start, end, label), ...]})
+    model: spaCy language model (or its name) used to tokenize the texts. If None, a blank 'en' model is used.
+    output_file: path to save the DocBin (.spacy). If None, the DocBin is not saved.
+    """
+    import spacy
+    from spacy.tokens import DocBin
+
+    nlp = spacy.load(model) if isinstance(model, str) else (model or spacy.blank('en'))
+
+    doc_bin = DocBin(attrs=['ENT_IOB', 'ENT_TYPE'])
+    for text, annotations in train_data:
+        doc = nlp.make_doc(text)
+        spans = [doc.char_span(start, end, label=label, alignment_mode='contract') 
+                for start, end, label in annotations.get('entities')]
+        spans = [span for span in spans if span is not None]
+        # Overlapping matches of the fuzzy matcher are not allowed in doc.ents
+        doc.ents = spacy.util.filter_spans(spans)
+        doc_bin.add(doc)
+
+    if output_file is not None:
+        doc_bin.to_disk(output_file)
+        print(f"Saved {len(doc_bin)} training docs to {output_file}")
+
+    return doc_bin
+
+
+def train_costume_NER(train_data, model=None, n_iter=50, batch=None, output_dir=None, eval_split=0.2, 
+                    patience=5, batch_start=4, batch_stop=32, batch_compound=1.001, drop=0.5, seed=0):
     """
     This function trains a custom NER using spaCy.
 
-    train_data: custom entity training data for spaCy NER pipeline.
+    train_data: custom entity training data for spaCy NER pipeline, or a DocBin (or the path of a .spacy file) 
+        created with TrainData_to_DocBin.
     model: spaCy language model
-    n_iter (int): number of iterations the training data is passed through the model trainer.
+    n_iter (int): maximum number of iterations the training data is passed through the model trainer.
     batch (int): number of training data instances to be passed in every interation of training.
+        If None (or larger than the training data left after the held-out split), all the training instances are used.
     output_dir: path to save the trained model
+    eval_split (float): share of the training data held out to evaluate the model after every iteration.
+        If 0, the model is not evaluated and the training runs n_iter iterations.
+    patience (int): the training stops when the NER F-score on the held-out data has not improved for 
+        patience iterations, and the best model is kept (the latest one if several have the best score).
+        While no iteration scores above 0, the training goes on and the last model is kept. 
+        If None, the training runs n_iter iterations.
+    batch_start, batch_stop, batch_compound: the minibatch size grows from batch_start to batch_stop 
+        by the factor batch_compound at every minibatch (spacy.util.compounding).
+    drop (float): dropout rate.
+    seed (int): seed of the held-out split and the shuffling of the training data.
     """
-    if batch is None:
-        batch = len(train_data)
+    import spacy
+    from spacy.training import Example
+    from spacy.tokens import DocBin
+    from spacy.language import Language
+    from spacy.util import minibatch, compounding
+
+    # A saved model may include the fuzzy_label_ruler
+    register_FuzzyLabelRuler()
 
     if model is not None:
         nlp = spacy.load(model)
@@ -156,6 +508,24 @@ def train_costume_NER(train_data, model=None, n_iter=50, batch=None, output_dir=
         nlp = spacy.blank('en')
         print("Created blank 'en' model")
 
+    # Create the Examples once, instead of once per sample and iteration
+    if isinstance(train_data, (str, Path)):
+        train_data = DocBin().from_disk(train_data)
+    if isinstance(train_data, DocBin):
+        examples = [Example(nlp.make_doc(doc.text), doc) for doc in train_data.get_docs(nlp.vocab)]
+    else:
+        examples = [Example.from_dict(nlp.make_doc(text), annotations) for text, annotations in train_data]
+
+    rng = random.Random(seed)
+    rng.shuffle(examples)
+    n_eval = int(len(examples) * eval_split) if len(examples) > 1 else 0
+    eval_examples, train_examples = examples[:n_eval], examples[n_eval:]
+    print(f"{len(train_examples)} training and {len(eval_examples)} evaluation examples")
+
+    if batch is None:
+        batch = len(train_examples)
+    batch = min(batch, len(train_examples))
+
     # set up the pipeline
     if 'ner' not in nlp.pipe_names:
         Language.component("ner")
@@ -165,9 +535,9 @@ def train_costume_NER(train_data, model=None, n_iter=50, batch=None, output_dir=
         ner = nlp.get_pipe('ner')
 
     # Add labels to the NER
-    for _, annotations in train_data:
-        for ent in annotations.get('entities'):
-            ner.add_label(ent[2])
+    for example in examples:
+        for ent in example.reference.ents:
+            ner.add_label(ent.label_)
 
     # Train the recognizer by disabling the unnecessary pipelines except for NER
     other_pipes = [pipe for pipe in nlp.pipe_names if pipe != 'ner']
@@ -176,21 +546,48 @@ def train_costume_NER(train_data, model=None, n_iter=50, batch=None, output_dir=
             optimizer = nlp.begin_training()
         else:
             optimizer = nlp.create_optimizer()
+
+        best_score, best_iter, best_weights, last_improvement = None, 0, None, 0
         for iter in range(n_iter):
-            random.shuffle(train_data)
+            start = time.perf_counter()
+            epoch = rng.sample(train_examples, batch)
             losses = {}
-            for text, entity_offsets in random.sample(train_data, batch):
-                doc = nlp.make_doc(text)
-                example = Example.from_dict(doc, entity_offsets)
-                nlp.update([example],
-                        drop=0.5,
+            n_words = 0
+            for minibatch_examples in minibatch(epoch, size=compounding(batch_start, batch_stop, batch_compound)):
+                nlp.update(minibatch_examples,
+                        drop=drop,
                         sgd=optimizer,
                         losses=losses)
-            print(f'Iter: {iter+1} - losses: {losses}')
+                n_words += sum(len(example.reference) for example in minibatch_examples)
+            epoch_time = time.perf_counter() - start
+
+            log = f'Iter: {iter+1} - losses: {losses} - {epoch_time:.1f}s, {n_words / epoch_time:.0f} words/sec'
+            if not eval_examples:
+                print(log)
+                continue
+
+            score = nlp.evaluate(eval_examples)['ents_f'] or 0.0
+            print(f'{log} - ents_f: {score:.3f}')
+
+            if (best_score is None) or (score > best_score):
+                best_score, best_iter, best_weights, last_improvement = score, iter, ner.to_bytes(), iter
+            elif score == best_score:
+                # On ties the later model is kept, but the patience runs from the last improvement
+                best_iter, best_weights = iter, ner.to_bytes()
+            # The patience only runs once the model scores above 0 on the held-out data
+            if (patience is not None) and (best_score > 0) and (iter - last_improvement >= patience):
+                print(f'Early stopping: no improvement since iteration {last_improvement+1}')
+                break
+
+        if (best_weights is not None) and (best_score > 0):
+            # Keep the model of the best iteration
+            if best_iter != iter:
+                ner.from_bytes(best_weights)
+            print(f'Best iteration: {best_iter+1} - ents_f: {best_score:.3f}')
 
     # Save the model to directory
     if output_dir is not None:
         nlp.to_disk(Path(output_dir))
         print("Saved model to ", output_dir)
 
-    return nlp
\ No newline at end of file
+    return nlp
@@ -0,0 +1,448 @@
+import os
+import pickle
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from rapidfuzz import fuzz
+from rapidfuzz import process
+from rapidfuzz import utils
+from Lookup_tagger import FuzzyMatcher, batch_match, LoadHTML, remove_unicode, parse_money, _remove_unicode, _parse_money
+from Lookup_tagger import LookupTagger, StageProfiler, loadTaxonomyXSD
+
+# Taxonomy (XSD) files of the repo, used by the offline benchmarks
+TAXONOMY_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Taxonomy files')
+
+""" SYNTHETIC DATA """
+
+WORDS = ['net', 'income', 'loss', 'total', 'assets', 'liabilities', 'cash', 'equivalents', 'equity',
+        'revenue', 'revenues', 'operating', 'expenses', 'interest', 'tax', 'deferred', 'current',
+        'non-current', 'stockholders', 'shares', 'common', 'preferred', 'dividends', 'accounts',
+        'receivable', 'payable', 'inventory', 'property', 'plant', 'equipment', 'goodwill', 'intangible',
+        'amortization', 'depreciation', 'provision', 'for', 'of', 'and', 'the', 'other', 'comprehensive']
+
+
+def random_label(rng, min_words=2, max_words=7):
+    """
+    Function to create a random row title from financial words
+    """
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize()
+
+
+def perturb(rng, string):
+    """
+    Function to add a small typo to a string
+    """
+    if len(string) < 2:
+        return string
+    i = rng.randrange(len(string) - 1)
+    return string[:i] + string[i+1] + string[i] + string[i+2:]
+
+
+def synthetic_lookup(n_keys, n_queries, seed=0):
+    """
+    Creates a lookup dict with n_keys random row titles and n_queries node texts, about half of which
+    are exact or slightly modified keys.
+    """
+    rng = random.Random(seed)
+    lookup_dict = {}
+    while len(lookup_dict) < n_keys:
+        lookup_dict[random_label(rng)] = 'Tag' + str(len(lookup_dict))
+
+    keys = list(lookup_dict)
+    queries = []
+    for _ in range(n_queries):
+        r = rng.random()
+        if r < 0.25:
+            queries.append(rng.choice(keys))
+        elif r < 0.5:
+            queries.append(perturb(rng, rng.choice(keys)))
+        elif r < 0.6:
+            queries.append(f'{rng.randint(1, 999)},{rng.randint(100, 999)}')
+        else:
+            queries.append(random_label(rng, 1, 12))
+
+    return lookup_dict, queries
+
+
+def synthetic_node_texts(n_texts, seed=0):
+    """
+    Creates the text data of n_texts html elements of a filing: row titles, monetary values, 
+    and repeated headers and notes with non-ASCII characters.
+    """
+    rng = random.Random(seed)
+    headers = ['Year Ended December\xa031,', '(in thousands)', '\u2014', '$', 'Total', 'See accompanying notes.']
+    texts = []
+    for _ in range(n_texts):
+        r = rng.random()
+        if r < 0.4:
+            value = f'{rng.randint(1, 999)},{rng.randint(100, 999)}'
+            texts.append(f'({value})' if rng.random() < 0.3 else value)
+        elif r < 0.7:
+            texts.append(rng.choice(headers))
+        else:
+            texts.append(random_label(rng).replace(' ', '\xa0', rng.randint(0, 1)))
+    return texts
+
+
+def html_node_texts(html_file):
+    """
+    Returns the text data (".string") of all the elements in the body of an html report.
+    """
+    parsed_html = LoadHTML(html_file)
+    return [str(elmnt.string) for elmnt in parsed_html.body.find_all() if elmnt.string]
+
+
+def synthetic_filings(folder, n_tables=50, n_rows=30, n_paragraphs=50, seed=0, tag_names=None, wrap_tables=False):
+    """
+    Writes a synthetic pair of reports to the folder: the previously filed inline xbrl report ("prev.htm"), with 
+    tagged monetary values in its tables, and the html report to be tagged ("cur.html"), with the same tables 
+    (row titles partly modified, new values) and narrative paragraphs.
+    Returns (html_file, xbrl_file)
+
+    n_tables, n_rows: number of tables and rows per table of the reports.
+    n_paragraphs: number of narrative paragraphs of the html report.
+    tag_names: taxonomy item names used as tags. If None, Tag0, Tag1, ... are used.
+    wrap_tables: wrap every table of the html report in a "div" element, as in many filings.
+    """
+    rng = random.Random(seed)
+    lookup_dict, _ = synthetic_lookup(n_tables * n_rows, 0, seed)
+    titles = list(lookup_dict)
+    if tag_names:
+        tag_names = list(tag_names)
+        lookup_dict = {title: tag_names[n % len(tag_names)] for n, title in enumerate(titles)}
+
+    def value():
+        value = f'{rng.randint(1, 999)},{rng.randint(100, 999)}'
+        return f'({value})' if rng.random() < 0.3 else value
+
+    xbrl = ['<html><body>']
+    html = ['<html><body>']
+    for t in range(n_tables):
+        rows = titles[t*n_rows:(t+1)*n_rows]
+        xbrl.append('<table>')
+        html.append('<div><table>' if wrap_tables else '<table>')
+        for title in rows:
+            tag = lookup_dict[title]
+            cells = ''.join(f'<td><ix:nonFraction name="us-gaap:{tag}" contextRef="c{c}" unitRef="usd">{value()}</ix:nonFraction></td>' 
+                            for c in range(2))
+            xbrl.append(f'<tr><td>{title}</td>{cells}</tr>')
+
+            title = perturb(rng, title) if rng.random() < 0.3 else title
+            html.append(f'<tr><td>{title}</td><td>{value()}</td><td>{value()}</td></tr>')
+        xbrl.append('</table>')
+        html.append('</table></div>' if wrap_tables else '</table>')
+
+        for _ in range(n_paragraphs // n_tables + (t < n_paragraphs % n_tables)):
+            html.append('<p>' + '. '.join(random_label(rng, 8, 20) for _ in range(rng.randint(1, 4))) + '.</p>')
+    xbrl.append('</body></html>')
+    html.append('</body></html>')
+
+    html_file = os.path.join(folder, 'cur.html')
+    xbrl_file = os.path.join(folder, 'prev.htm')
+    with open(html_file, 'w') as f:
+        f.write('\n'.join(html))
+    with open(xbrl_file, 'w') as f:
+        f.write('\n'.join(xbrl))
+    return html_file, xbrl_file
+
+
+def _legacy_remove_unicode(string):
+    string_unicode = re.sub(pattern=r'(\xa0\s*)+', repl=' ', string=string)
+    string_encode = string_unicode.encode("ascii", "xmlcharrefreplace")
+    string_decode = string_encode.decode()
+    string_decode = re.sub(pattern=r'(&#\d+;\s*)+', repl=' ', string=string_decode)
+    return string_decode
+
+
+def _legacy_parse_money(string):
+    if re.fullmatch(pattern=r'\s*\(?(\d+(,\d+)+)\)?\s*', string=string):
+        value = int(re.sub(pattern=r'\(|\)|,|\s', repl='', string=string))
+        sign = 'Negative' if string.startswith('(') else 'Positive'
+        return (value, sign)
+    return None
+
+
+""" BENCHMARKS """
+
+def benchmark_matcher(n_keys=2000, n_queries=5000, score_cutoff=95, seed=0):
+    """
+    Compares FuzzyMatcher with the brute-force process.extractOne over all keys of the lookup dict.
+    Returns a dict of the timings and raises AssertionError if the matches are not the same.
+    """
+    lookup_dict, queries = synthetic_lookup(n_keys, n_queries, seed)
+
+    start = time.perf_counter()
+    brute = []
+    for string in queries:
+        match = process.extractOne(string, lookup_dict.keys(), scorer=fuzz.WRatio,
+                                processor=utils.default_process)
+        brute.append(match[0] if match and (match[1] >= score_cutoff) else None)
+    brute_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = FuzzyMatcher(lookup_dict, score_cutoff=score_cutoff)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = []
+    for string in queries:
+        match = matcher.match(string)
+        indexed.append(match[0] if match else None)
+    match_time = time.perf_counter() - start
+
+    assert brute == indexed, 'FuzzyMatcher returned different matches than the brute-force search'
+
+    results = {'keys': n_keys,
+            'queries': n_queries,
+            'matches': sum(m is not None for m in indexed),
+            'brute_force_s': brute_time,
+            'index_build_s': build_time,
+            'indexed_s': match_time,
+            'speedup': brute_time / (build_time + match_time)}
+
+    print(f"FuzzyMatcher: {n_keys} keys x {n_queries} queries, {results['matches']} matches - "
+        f"brute force {brute_time:.2f}s, indexed {build_time + match_time:.2f}s "
+        f"({results['speedup']:.1f}x)")
+    return results
+
+
+def benchmark_batch_match(n_keys=2000, n_queries=5000, score_cutoff=95, workers=-1, seed=0):
+    """
+    Compares batch_match (one cdist pass over all the queries) with FuzzyMatcher (one query at a time).
+    Returns a dict of the timings and raises AssertionError if the matches are not the same.
+    """
+    lookup_dict, queries = synthetic_lookup(n_keys, n_queries, seed)
+
+    start = time.perf_counter()
+    matcher = FuzzyMatcher(lookup_dict, score_cutoff=score_cutoff)
+    indexed = {}
+    for string in queries:
+        match = matcher.match(string)
+        if match:
+            indexed[string] = match[0]
+    indexed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = batch_match(queries, lookup_dict, score_cutoff=score_cutoff, workers=workers)
+    batch_time = time.perf_counter() - start
+
+    assert indexed == batched, 'batch_match returned different matches than FuzzyMatcher'
+
+    results = {'keys': n_keys,
+            'queries': n_queries,
+            'matches': len(batched),
+            'indexed_s': indexed_time,
+            'batch_s': batch_time,
+            'speedup': indexed_time / batch_time}
+
+    print(f"batch_match: {n_keys} keys x {n_queries} queries, {results['matches']} matches - "
+        f"indexed {indexed_time:.2f}s, batch {batch_time:.2f}s ({results['speedup']:.1f}x)")
+    return results
+
+
+def benchmark_normalization(html_file=None, n_texts=200000, seed=0):
+    """
+    Compares remove_unicode and parse_money (precompiled patterns, cache and ASCII fast path) with the 
+    previous inline re.sub/re.fullmatch implementation on the node texts of a filing.
+
+    html_file: html report whose node texts are used. If None, n_texts synthetic node texts are used.
+    """
+    texts = html_node_texts(html_file) if html_file else synthetic_node_texts(n_texts, seed)
+
+    start = time.perf_counter()
+    legacy = [(_legacy_remove_unicode(t), _legacy_parse_money(t)) for t in texts]
+    legacy_time = time.perf_counter() - start
+
+    _remove_unicode.cache_clear()
+    _parse_money.cache_clear()
+    start = time.perf_counter()
+    current = [(remove_unicode(t), parse_money(t)) for t in texts]
+    current_time = time.perf_counter() - start
+
+    assert legacy == current, 'remove_unicode/parse_money returned different results than the previous implementation'
+
+    results = {'texts': len(texts),
+            'unique_texts': len(set(texts)),
+            'legacy_s': legacy_time,
+            'current_s': current_time,
+            'speedup': legacy_time / current_time}
+
+    print(f"Text normalization: {len(texts)} node texts ({results['unique_texts']} unique) - "
+        f"legacy {legacy_time:.2f}s, current {current_time:.2f}s ({results['speedup']:.1f}x)")
+    return results
+
+def benchmark_ruler(n_labels=500, n_sents=100, train_data_file='NER_Train_Data.txt', seed=0):
+    """
+    Compares the throughput (sentences/sec) of the fuzzy_label_ruler (NERmodel_trainer.FuzzyLabelRuler) with 
+    the spaczz_ruler on the sentences of the NER training data, with n_labels random taxonomy-like labels 
+    and the labels of the training data as patterns. Returns a dict of the timings and of the number of 
+    entities found by each ruler.
+
+    train_data_file: pickle of the NER training data (list of (text, annotations)); its sentences are repeated
+        up to n_sents sentences.
+    """
+    import pandas as pd
+    import spacy
+    from NERmodel_trainer import add_pipe_SpaczzRuler, add_pipe_FuzzyLabelRuler
+
+    rng = random.Random(seed)
+    with open(train_data_file, 'rb') as fp:
+        train_data = pickle.load(fp)
+    sents = [train_data[i % len(train_data)][0] for i in range(n_sents)]
+
+    labels = {ent[2]: ent[2] for _, annotations in train_data for ent in annotations['entities']}
+    n_patterns = len(labels) + n_labels
+    while len(labels) < n_patterns:
+        label = random_label(rng, 1, 5)
+        labels[label.title().replace(' ', '')] = label
+    Labels = pd.DataFrame({'name': list(labels.keys()), 'label': list(labels.values())})
+
+    results = {'labels': len(Labels), 'sentences': n_sents}
+    for ruler in ('spaczz_ruler', 'fuzzy_label_ruler'):
+        nlp = spacy.blank('en')
+        start = time.perf_counter()
+        if ruler == 'spaczz_ruler':
+            component = add_pipe_SpaczzRuler(Labels, nlp, in_pipeline=True)
+        else:
+            component = add_pipe_FuzzyLabelRuler(Labels, nlp)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        n_ents = sum(len(component(nlp.make_doc(sent)).ents) for sent in sents)
+        match_time = time.perf_counter() - start
+
+        results[ruler] = {'build_s': build_time, 'sents_per_s': n_sents / match_time, 'entities': n_ents}
+        print(f"{ruler}: {len(Labels)} patterns, {n_sents} sentences - build {build_time:.2f}s, "
+            f"{n_sents / match_time:.1f} sentences/sec, {n_ents} entities")
+
+    return results
+
+def benchmark_tagger(sizes=(10, 50, 200), n_rows=30, resources=TAXONOMY_FILES, seed=0, sink=None, **kwargs):
+    """
+    Tags synthetic reports of increasing size (see synthetic_filings) with LookupTagger.GetTags, offline 
+    (XSD taxonomy files of the repo), and prints the timings and counters of every stage (see StageProfiler).
+    Returns the list of the profiler reports, one per size.
+
+    sizes: numbers of tables of the synthetic reports.
+    sink: sink of the profiler reports, e.g. jsonSink(file) to save them.
+    kwargs: other arguments of GetTags, e.g. batch=True.
+    """
+    reports = []
+    with tempfile.TemporaryDirectory() as folder:
+        tag_names = [element['@name'] for element in loadTaxonomyXSD(resources, None)['xs:element']]
+        tagger = LookupTagger(resources, cache_dir=os.path.join(folder, 'cache'), profiler=StageProfiler(sink))
+        print(f"Taxonomy load: {tagger.profiler.last['timings']['taxonomy_load']:.2f}s")
+
+        for n_tables in sizes:
+            html_file, xbrl_file = synthetic_filings(folder, n_tables, n_rows, n_tables, seed, tag_names)
+            size = os.path.getsize(html_file) + os.path.getsize(xbrl_file)
+            tagger.documents.clear()
+            tagger.GetTags(html_file, xbrl_file, **kwargs)
+
+            report = dict(tagger.profiler.last, tables=n_tables, rows=n_tables * n_rows, bytes=size)
+            reports.append(report)
+            timings = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in report['timings'].items())
+            counters = ', '.join(f'{name} {count}' for name, count in report['counters'].items())
+            print(f"GetTags: {n_tables} tables x {n_rows} rows ({size / 1e6:.1f} MB) - {timings}")
+            print(f"    {counters}")
+
+    return reports
+
+def benchmark_document_cache(n_tables=20, n_rows=30, max_documents=(0, 1, 2), resources=TAXONOMY_FILES, seed=0):
+    """
+    Tags the same synthetic reports (see synthetic_filings) with taggers keeping 0, 1 and 2 parsed documents 
+    in their DocumentCache. Returns a dict of the GetTags timings and raises AssertionError if the tags 
+    (or the table row titles of the lookup dict) are not the same for every max_documents.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        tag_names = [element['@name'] for element in loadTaxonomyXSD(resources, None)['xs:element']]
+        html_file, xbrl_file = synthetic_filings(folder, n_tables, n_rows, n_tables, seed, tag_names)
+
+        tags = {}
+        for n in max_documents:
+            tagger = LookupTagger(resources, cache_dir=os.path.join(folder, 'cache'), max_documents=n)
+            start = time.perf_counter()
+            tags[n] = (tagger.GetTags(html_file, xbrl_file), tagger.firmDict[0])
+            results[n] = time.perf_counter() - start
+            print(f"DocumentCache: max_documents={n} - {len(tags[n][1])} table rows, {len(tags[n][0])} tags, "
+                f"GetTags {results[n]:.2f}s")
+
+    first = tags[max_documents[0]]
+    assert first[1], 'No table rows found in the previously filed xbrl report'
+    assert all(tags[n] == first for n in max_documents), 'GetTags returned different tags for different max_documents'
+    return results
+
+def benchmark_ner_lookup(n_tables=10, n_rows=30, resources=TAXONOMY_FILES, seed=0):
+    """
+    Tags the same synthetic reports, with their tables wrapped in "div" elements (see synthetic_filings), 
+    without NER model and with a blank spaCy model (no entities). Returns a dict of the GetTags timings and 
+    raises AssertionError if no tags are found or if the NER model changes the lookup tags of the tables.
+    """
+    import spacy
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        tag_names = [element['@name'] for element in loadTaxonomyXSD(resources, None)['xs:element']]
+        html_file, xbrl_file = synthetic_filings(folder, n_tables, n_rows, n_tables, seed, tag_names, wrap_tables=True)
+
+        tags = {}
+        for name, ner_model in (('lookup', None), ('blank_ner', spacy.blank('en'))):
+            tagger = LookupTagger(resources, cache_dir=os.path.join(folder, 'cache'), ner_model=ner_model)
+            start = time.perf_counter()
+            tags[name] = tagger.GetTags(html_file, xbrl_file)
+            results[name] = time.perf_counter() - start
+            print(f"NER lookup: {name} - {len(tags[name])} tags, GetTags {results[name]:.2f}s")
+
+    assert tags['lookup'], 'No tags found in the tables wrapped in div elements'
+    assert tags['blank_ner'] == tags['lookup'], 'A NER model without entities changed the lookup tags'
+    return results
+
+
+# Modules of the repo and the heavy libraries which must not be imported when the module is imported
+LAZY_IMPORTS = {'Xbrl_Parser': ['xbrl', 'pandas'],
+                'Lookup_tagger': ['xbrl', 'pandas', 'numpy', 'bs4', 'lxml', 'requests'],
+                'NERmodel_trainer': ['spacy', 'spaczz']}
+
+def benchmark_imports(modules=LAZY_IMPORTS, max_seconds=None):
+    """
+    Measures the import time of the modules, each in a new Python process, and checks that the heavy 
+    libraries are not imported with them. Raises AssertionError if a heavy library is imported or if an
+    import takes longer than max_seconds.
+
+    modules: dict of {module name: list of the libraries which must not be imported}
+    max_seconds: maximum import time of a module. If None, the time is not checked.
+    """
+    code = ('import sys, time; start = time.perf_counter(); import {module}; '
+            'print(time.perf_counter() - start); print(",".join(sorted(m for m in sys.modules if "." not in m)))')
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    results = {}
+    for module, heavy in modules.items():
+        out = subprocess.run([sys.executable, '-c', code.format(module=module)], cwd=folder, 
+                            capture_output=True, text=True, check=True).stdout.split('\n')
+        seconds = float(out[0])
+        loaded = set(out[1].split(','))
+        results[module] = seconds
+
+        print(f"Import {module}: {seconds:.3f}s")
+        imported = sorted(loaded.intersection(heavy))
+        assert not imported, f'{module} imports {", ".join(imported)} at module load'
+        if max_seconds is not None:
+            assert seconds <= max_seconds, f'{module} takes {seconds:.2f}s to import'
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_imports()
+    benchmark_matcher()
+    benchmark_batch_match()
+    benchmark_normalization()
+    benchmark_ruler()
+    benchmark_tagger()
+    benchmark_document_cache()
+    benchmark_ner_lookup()
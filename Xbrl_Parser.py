@@ -1,8 +1,134 @@
-from xbrl.cache import HttpCache
-from xbrl.instance import XbrlParser
+import os
+import glob
+import multiprocessing
+from functools import lru_cache
+from zipfile import ZipFile
+# py-xbrl and pandas are imported when the first file is parsed, so importing this module stays fast
 
-cache = HttpCache('./cache')
-xbrlParser = XbrlParser(cache)
+# Folder where py-xbrl caches the taxonomy schemas (independent of the working directory)
+XBRL_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xbrl_cache')
+
+# Parser settings (see configure_parser). The parser is only created when the first file is parsed.
+_parser_config = {'cache_dir': XBRL_CACHE, 'offline': False, 'shared': True}
+_parsers = []
+
+
+class XbrlCache():
+    """
+    Wrapper of the py-xbrl HttpCache which memoizes the local path of every schema url, so each schema is 
+    looked up once per process, and which can run offline on a pre-seeded cache folder (see seed_cache).
+    The other attributes and methods are the ones of the HttpCache.
+
+    cache_dir: folder of the cached files.
+    offline: if True, files are never downloaded and a FileNotFoundError is raised for missing files.
+    """
+    def __init__(self, cache_dir, offline = False, **kwargs):
+        from xbrl.cache import HttpCache
+
+        self.http_cache = HttpCache(cache_dir, **kwargs)
+        self.offline = offline
+        self.cached_files = {}
+
+    def __getattr__(self, name):
+        return getattr(self.http_cache, name)
+
+    def cache_file(self, file_url):
+        file_path = self.cached_files.get(file_url)
+        if file_path is None:
+            if self.offline:
+                file_path = self.url_to_path(file_url)
+                if not os.path.isfile(file_path):
+                    raise FileNotFoundError(f'"{file_url}" is not in the offline xbrl cache {self.cache_dir}')
+            else:
+                file_path = self.http_cache.cache_file(file_url)
+            self.cached_files[file_url] = file_path
+        return file_path
+
+
+def seed_cache(bundle_zip, cache_dir = None):
+    """
+    Function to extract an offline taxonomy bundle (zip of a cache folder, see bundle_cache) into the xbrl cache,
+    so filings can be parsed without network access.
+
+    bundle_zip: path of the bundle.
+    cache_dir: folder of the xbrl cache. If None, the configured cache folder is used.
+    """
+    cache_dir = cache_dir or _parser_config['cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+    with ZipFile(bundle_zip) as zf:
+        zf.extractall(cache_dir)
+    print(f'Xbrl cache seeded from {bundle_zip}')
+
+
+def bundle_cache(bundle_zip, cache_dir = None):
+    """
+    Function to pack the files of the xbrl cache into a zip, which can be used to seed the cache of 
+    another machine or worker (see seed_cache).
+
+    bundle_zip: path of the bundle.
+    cache_dir: folder of the xbrl cache. If None, the configured cache folder is used.
+    """
+    cache_dir = cache_dir or _parser_config['cache_dir']
+    with ZipFile(bundle_zip, 'w') as zf:
+        for root, _, files in os.walk(cache_dir):
+            for name in files:
+                file_path = os.path.join(root, name)
+                zf.write(file_path, os.path.relpath(file_path, cache_dir))
+    print(f'Xbrl cache saved to {bundle_zip}')
+
+
+def configure_parser(cache_dir = None, offline = None, bundle = None, shared = None):
+    """
+    Function to set up the py-xbrl parser used by read_xbrl and read_xbrl_facts. Must be called before the 
+    worker processes are started for the settings to apply in the workers.
+
+    cache_dir: folder of the cached taxonomy schemas.
+    offline: if True, schemas are only read from the cache folder and never downloaded.
+    bundle: zip of a pre-seeded cache folder to be extracted into cache_dir (see seed_cache).
+    shared: if True, one parser (and its parsed taxonomies) is shared by all the files parsed in a process,
+        otherwise a new parser is created for every file.
+    
+    Arguments left to None keep their current value.
+    """
+    for key, value in (('cache_dir', cache_dir), ('offline', offline), ('shared', shared)):
+        if value is not None:
+            _parser_config[key] = value
+
+    if bundle is not None:
+        seed_cache(bundle, _parser_config['cache_dir'])
+
+    # Parsers and instances created with the previous settings are dropped
+    _parsers.clear()
+    _parse_instance.cache_clear()
+
+
+def get_parser():
+    """
+    Returns the py-xbrl parser of the current process, created with the settings of configure_parser.
+    """
+    if _parser_config['shared'] and _parsers:
+        # Forked workers get their own copy of the parent's parser, with the schemas it has already parsed
+        return _parsers[0]
+
+    from xbrl.instance import XbrlParser
+
+    parser = XbrlParser(XbrlCache(_parser_config['cache_dir'], offline=_parser_config['offline']))
+    if _parser_config['shared']:
+        _parsers.append(parser)
+    return parser
+
+
+@lru_cache(maxsize=8)
+def _parse_instance(file_path, mtime):
+    return get_parser().parse_instance_locally(file_path)
+
+
+def load_instance(file_path):
+    """
+    Parses a xbrl file with py-xbrl. The parsed instance is cached, so a file is parsed once per run 
+    (unless it is modified) even if it is read several times.
+    """
+    return _parse_instance(os.path.abspath(file_path), os.path.getmtime(file_path))
 
 def read_xbrl(file_path, selected_facts = None, values = True, non_dimensional = False):
     """
@@ -20,9 +146,11 @@ def read_xbrl(file_path, selected_facts = None, values = True, non_dimensional =
     """
 
     # Initialize the parser
-    inst = xbrlParser.parse_instance_locally(file_path)
+    inst = load_instance(file_path)
 
     extracted_data = {}
+    if selected_facts:
+        selected_facts = set(selected_facts)
 
     for fact in inst.facts:
 
@@ -45,3 +173,97 @@ def read_xbrl(file_path, selected_facts = None, values = True, non_dimensional =
         
     return extracted_data
 
+
+# Columns of the DataFrame returned by read_xbrl_facts
+FACT_COLUMNS = ['concept', 'label', 'context', 'start_date', 'end_date', 'dimensions', 'value', 'unit', 'decimals', 'fact_id']
+
+def read_xbrl_facts(file_path, selected_facts = None, non_dimensional = False, cached = True):
+    """
+    This function parses a xbrl file with py-xbrl and returns all the facts of the selected concepts as a 
+    DataFrame with one row per fact (the facts of the same concept in different contexts are all kept).
+
+        file_path: path to the .htm (xbrl) file.
+        selected_facts: facts (taxonomy tag names) to be extracted from the xbrl file. If None, all the facts are extracted.
+            > set (or list) of names
+        non_dimensional: only select non-dimensional data.
+        cached: reuse the parsed instance of load_instance. If False, the file is parsed without keeping the 
+            instance in memory (e.g. when many files are read once).
+
+    Columns: concept, label, context, start_date, end_date (the date of instant contexts), 
+        dimensions ("dimension=member" separated by ";"), value, unit, decimals, fact_id
+    """
+    import pandas as pd
+
+    if cached:
+        inst = load_instance(file_path)
+    else:
+        inst = get_parser().parse_instance_locally(file_path)
+
+    if selected_facts is not None:
+        selected_facts = frozenset(selected_facts)
+
+    columns = {col: [] for col in FACT_COLUMNS}
+    for fact in inst.facts:
+        concept = fact.concept
+        if (selected_facts is not None) and (concept.name not in selected_facts):
+            continue
+
+        context = fact.context
+        if non_dimensional and context.segments:
+            continue
+
+        columns['concept'].append(concept.name)
+        columns['label'].append(concept.labels[-1].text if concept.labels else None)
+        columns['context'].append(context.xml_id)
+        columns['start_date'].append(getattr(context, 'start_date', None))
+        columns['end_date'].append(getattr(context, 'end_date', getattr(context, 'instant_date', None)))
+        columns['dimensions'].append(';'.join(f'{seg.dimension.name}={getattr(getattr(seg, "member", None), "name", "")}' 
+                                            for seg in context.segments))
+        columns['value'].append(fact.value)
+        columns['unit'].append(fact.unit.unit_id if getattr(fact, 'unit', None) is not None else None)
+        columns['decimals'].append(getattr(fact, 'decimals', None))
+        columns['fact_id'].append(fact.xml_id)
+
+    return pd.DataFrame(columns, columns=FACT_COLUMNS)
+
+
+def _read_xbrl_facts_job(job):
+    file_path, selected_facts, non_dimensional = job
+    try:
+        # Every file is read once, so the parsed instance is not kept in the load_instance cache
+        return file_path, read_xbrl_facts(file_path, selected_facts, non_dimensional, cached=False), None
+    except Exception as e:
+        return file_path, None, repr(e)
+
+
+def read_xbrl_dir(folder, selected_facts = None, non_dimensional = False, pattern = '*.htm', processes = 1):
+    """
+    This function extracts the facts of all the xbrl files in a folder (see read_xbrl_facts) into one DataFrame, 
+    with the file path of every fact in the column "file". Files which cannot be parsed are skipped and reported.
+
+        folder: folder of the xbrl files.
+        pattern: glob pattern of the xbrl files in the folder.
+        processes: number of worker processes used to parse the files.
+    """
+    import pandas as pd
+
+    files = sorted(glob.glob(os.path.join(folder, pattern)))
+    jobs = [(f, selected_facts, non_dimensional) for f in files]
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_read_xbrl_facts_job, jobs, chunksize=1)
+    else:
+        results = [_read_xbrl_facts_job(job) for job in jobs]
+
+    frames = []
+    for file_path, facts, error in results:
+        if error is not None:
+            print(f'File "{file_path}" is skipped: {error}')
+            continue
+        facts.insert(0, 'file', file_path)
+        frames.append(facts)
+
+    if not frames:
+        return pd.DataFrame(columns=['file'] + FACT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)